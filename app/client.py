@@ -0,0 +1,69 @@
+"""Client for the shell's server mode (main.py --server socket).
+
+    python3 -m app.client socket [-e] -c command
+
+Sends the command with this process's cwd, environment and stdin, stdout
+and stderr to the server, which runs it in a forked child writing straight
+to those fds. Exits with the command's status. Only the standard library's
+socket and json are imported, so startup stays close to the bare
+interpreter's.
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+def usage():
+    print("usage: client.py socket [-e] -c command", file=sys.stderr)
+    sys.exit(2)
+
+
+def main(argv=None):
+    args = list(sys.argv[1:] if argv is None else argv)
+    if not args:
+        usage()
+    path = args.pop(0)
+    errexit = False
+    command = None
+    while args:
+        opt = args.pop(0)
+        if opt == "-e":
+            errexit = True
+        elif opt == "-c" and args:
+            command = args.pop(0)
+        else:
+            usage()
+    if command is None:
+        usage()
+
+    payload = json.dumps({
+        "line": command,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "errexit": errexit,
+    }).encode("utf-8", "surrogateescape")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        request = len(payload).to_bytes(4, "big") + payload
+        sent = socket.send_fds(sock, [request], [0, 1, 2])
+        sock.sendall(request[sent:])
+        reply = b""
+        while chunk := sock.recv(64):
+            reply += chunk
+    except OSError as e:
+        print(f"{path}: {e.strerror}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        sock.close()
+    try:
+        sys.exit(int(reply))
+    except ValueError:
+        print(f"{path}: no status from server", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
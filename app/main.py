@@ -1,35 +1,606 @@
-import shutil
+import bisect
+import errno
+import functools
+import mmap
 import sys
-import subprocess
 import os
-import shlex
-import io
+import re
+import resource
+import select
+import signal
+import stat
+import threading
+import time
 
-try:
-    import readline
-except ImportError:
-    import pyreadline3 as readline
+# Modules that only some commands need (subprocess, json, concurrent.futures,
+# readline) are imported where they are used, so a shell started from a
+# script pays only for what it runs.
+readline = None
 
-tab_state = {"last_prefix": "", "tab_count": 0, "matches": []}
+tab_state = {"last_prefix": None, "tab_count": 0, "matches": []}
 
-def get_executable_completions(prefix):
-    builtins = ["echo", "exit", "type", "pwd", "cd"]
-    completions = [cmd for cmd in builtins if cmd.startswith(prefix)]
-    path_dirs = os.environ.get("PATH", "").split(os.pathsep)
-    seen = set(completions)
-    for dir in path_dirs:
-        if not os.path.isdir(dir):
+# Reserved words, which type reports but which are not commands
+shell_keywords = {"time", "!", "if", "then", "elif", "else", "fi", "for", "in", "while", "until", "do", "done",
+                  "function", "{", "}"}
+
+builtins = {"echo", "exit", "type", "pwd", "cd", "hash", "jobs", "wait", "fg", "bg", "kill", "parallel", "history",
+            "export", "unset", "local", "true", "false", ":", "test", "[", "break", "continue", "return"}
+
+# Builtins that change the shell itself, so $(...) runs them in a forked
+# subshell rather than in-process
+state_builtins = {"cd", "exit", "export", "unset", "hash", "jobs", "wait", "fg", "bg", "local", "break", "continue",
+                  "return"}
+
+# Exit status of the last command and of every stage of the last pipeline
+# (bash's $? and PIPESTATUS), plus the pid of the last background job ($!).
+# positional holds $1.. and locals one frame of saved variables per
+# running function; loop_depth counts the loops break and continue can end.
+shell_state = {"last_status": 0, "pipestatus": [0], "last_job_pid": None, "interactive": False,
+               "parse_s": 0.0, "pid": os.getpid(), "subst_status": None, "positional": [], "locals": [],
+               "loop_depth": 0, "errexit": False, "errexit_ignored": 0}
+
+# Shell variables that are not exported; exported ones live in os.environ
+shell_vars = {}
+
+# Function bodies by name, as parsed compound commands
+shell_functions = {}
+
+# Remembered command locations, like bash's hash table. Entries are
+# name -> [full path, directory, directory mtime, hits] and the whole table
+# is dropped whenever PATH changes. While a loop runs, pinned maps the names
+# it has already resolved to their paths, so later iterations skip even the
+# directory stat; it is dropped with the table when PATH changes.
+command_hash = {"path": None, "entries": {}, "pinned": None}
+
+def is_executable(path):
+    return os.path.isfile(path) and os.access(path, os.X_OK)
+
+def search_path(name, path):
+    """Scan PATH for name, returning (full path, directory) or None."""
+    for dir in path.split(os.pathsep):
+        full_path = os.path.join(dir or ".", name)
+        if is_executable(full_path):
+            return full_path, dir or "."
+    return None
+
+def find_executable(name):
+    """Resolve a command name through the hash table, searching PATH on a miss."""
+    if os.sep in name:
+        return name if is_executable(name) else None
+    path = os.environ.get("PATH", os.defpath)
+    if path != command_hash["path"]:
+        command_hash["path"] = path
+        command_hash["entries"].clear()
+        if command_hash["pinned"]:
+            command_hash["pinned"].clear()
+    pinned = command_hash["pinned"]
+    if pinned is None:
+        return hashed_executable(name, path)
+    full_path = pinned.get(name)
+    if full_path is None:
+        full_path = hashed_executable(name, path)
+        if full_path is not None:
+            pinned[name] = full_path
+    return full_path
+
+def hashed_executable(name, path):
+    """The hash table lookup behind find_executable."""
+    entries = command_hash["entries"]
+    entry = entries.get(name)
+    if entry is not None:
+        # One stat of the containing directory notices the binary being
+        # removed or replaced without rescanning the whole PATH.
+        try:
+            if os.stat(entry[1]).st_mtime_ns == entry[2]:
+                entry[3] += 1
+                return entry[0]
+        except OSError:
+            pass
+        del entries[name]
+    found = search_path(name, path)
+    if found is None:
+        return None
+    full_path, dir = found
+    # Relative PATH entries depend on the cwd, so they are never remembered
+    if os.path.isabs(dir):
+        try:
+            entries[name] = [full_path, dir, os.stat(dir).st_mtime_ns, 1]
+        except OSError:
+            pass
+    return full_path
+
+def hash_builtin(args, out, err):
+    entries = command_hash["entries"]
+    if not args:
+        if not entries:
+            print("hash: hash table empty", file=out)
+            return 0
+        print("hits\tcommand", file=out)
+        for name, entry in entries.items():
+            print(f"{entry[3]:4d}\t{entry[0]}", file=out)
+        return 0
+    status = 0
+    if args[0] == "-r":
+        entries.clear()
+        if command_hash["pinned"]:
+            command_hash["pinned"].clear()
+        return 0
+    if args[0] == "-d":
+        for name in args[1:]:
+            if entries.pop(name, None) is None:
+                print(f"hash: {name}: not found", file=err)
+                status = 1
+        return status
+    for name in args:
+        if name in builtins:
+            continue
+        # Re-search PATH so a stale entry is replaced, as bash does
+        entries.pop(name, None)
+        if find_executable(name) is None:
+            print(f"hash: {name}: not found", file=err)
+            status = 1
+        elif name in entries:
+            entries[name][3] = 0
+    return status
+
+NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+def param_value(name):
+    """The value of $name, "" when unset."""
+    if name == "?":
+        return str(shell_state["last_status"])
+    if name == "!":
+        pid = shell_state["last_job_pid"]
+        return "" if pid is None else str(pid)
+    if name == "$":
+        return str(shell_state["pid"])
+    if name == "#":
+        return str(len(shell_state["positional"]))
+    if name in ("@", "*"):
+        return " ".join(shell_state["positional"])
+    if name == "0":
+        return sys.argv[0]
+    if name == "PIPESTATUS":
+        # There are no arrays; the statuses read like "${PIPESTATUS[*]}"
+        return " ".join(map(str, shell_state["pipestatus"]))
+    if name.isdigit():
+        positional = shell_state["positional"]
+        index = int(name)
+        return positional[index - 1] if index <= len(positional) else ""
+    if name in shell_vars:
+        return shell_vars[name]
+    return os.environ.get(name, "")
+
+def set_variable(name, value):
+    """Assign a variable, keeping an exported one in the environment."""
+    if name not in shell_vars and name in os.environ:
+        os.environ[name] = value
+    else:
+        shell_vars[name] = value
+
+def export_builtin(args, out, err):
+    if not args or args == ["-p"]:
+        for name in sorted(os.environ):
+            value = re.sub(r'([\\"$`])', r"\\\1", os.environ[name])
+            print(f'declare -x {name}="{value}"', file=out)
+        return 0
+    status = 0
+    for arg in args:
+        name, eq, value = arg.partition("=")
+        if not NAME_RE.fullmatch(name):
+            print(f"export: `{arg}': not a valid identifier", file=err)
+            status = 1
+        elif eq:
+            shell_vars.pop(name, None)
+            os.environ[name] = value
+        elif name in shell_vars:
+            os.environ[name] = shell_vars.pop(name)
+    return status
+
+def unset_builtin(args, out, err):
+    status = 0
+    for name in args:
+        if name == "-v":
+            continue
+        if not NAME_RE.fullmatch(name):
+            print(f"unset: `{name}': not a valid identifier", file=err)
+            status = 1
+            continue
+        shell_vars.pop(name, None)
+        os.environ.pop(name, None)
+    return status
+
+def local_builtin(args, out, err):
+    """Make variables local to the running function.
+
+    Their values from before the call are saved in the function's frame
+    and put back when it returns.
+    """
+    if not shell_state["locals"]:
+        print("local: can only be used in a function", file=err)
+        return 1
+    frame = shell_state["locals"][-1]
+    status = 0
+    for arg in args:
+        name, eq, value = arg.partition("=")
+        if not NAME_RE.fullmatch(name):
+            print(f"local: `{arg}': not a valid identifier", file=err)
+            status = 1
+            continue
+        if name not in frame:
+            frame[name] = (shell_vars.get(name), os.environ.get(name))
+        set_variable(name, value)
+    return status
+
+def restore_locals(frame):
+    for name, (value, exported) in frame.items():
+        for table, saved in ((shell_vars, value), (os.environ, exported)):
+            if saved is None:
+                table.pop(name, None)
+            else:
+                table[name] = saved
+
+# Executable names on PATH, kept per directory with the mtime they were read
+# at and merged into one sorted list so prefix lookups are a bisect.
+completion_index = {"path": None, "dirs": {}, "names": []}
+
+def scan_executables(dir):
+    names = []
+    with os.scandir(dir) as it:
+        for entry in it:
+            try:
+                if entry.is_file() and os.access(entry.path, os.X_OK):
+                    names.append(entry.name)
+            except OSError:
+                continue
+    return names
+
+def refresh_completion_index():
+    """Rescan only the PATH directories whose mtime changed since the last call."""
+    path = os.environ.get("PATH", "")
+    old_dirs = completion_index["dirs"]
+    changed = path != completion_index["path"]
+    dirs = {}
+    for dir in path.split(os.pathsep):
+        if not dir or dir in dirs:
             continue
         try:
-            for fname in os.listdir(dir):
-                if fname.startswith(prefix):
-                    full_path = os.path.join(dir, fname)
-                    if os.access(full_path, os.X_OK) and fname not in seen:
-                        completions.append(fname)
-                        seen.add(fname)
-        except Exception:
+            mtime = os.stat(dir).st_mtime_ns
+        except OSError:
+            continue
+        cached = old_dirs.get(dir)
+        if cached is None or cached[0] != mtime:
+            try:
+                cached = (mtime, scan_executables(dir))
+            except OSError:
+                continue
+            changed = True
+        dirs[dir] = cached
+    if changed or len(dirs) != len(old_dirs):
+        names = set(builtins)
+        for _, dir_names in dirs.values():
+            names.update(dir_names)
+        completion_index["names"] = sorted(names)
+    completion_index["path"] = path
+    completion_index["dirs"] = dirs
+
+def get_executable_completions(prefix):
+    refresh_completion_index()
+    names = completion_index["names"]
+    completions = []
+    for i in range(bisect.bisect_left(names, prefix), len(names)):
+        if not names[i].startswith(prefix):
+            break
+        completions.append(names[i])
+    return completions
+
+# Directory listings for pathname expansion, keyed by absolute path and kept
+# with the directory's mtime: (mtime, sorted names, subdirectory names,
+# symlink names). A listing is reused until its directory changes, so a
+# script globbing the same tree repeatedly reads each directory once.
+glob_cache = {}
+
+GLOB_ESCAPE_RE = re.compile(r"\\(.)", re.DOTALL)
+
+def directory_key(path):
+    return path if os.path.isabs(path) else os.path.join(os.getcwd(), path)
+
+def list_directory(path):
+    """The cached listing of path, or None if it cannot be read."""
+    key = directory_key(path)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = glob_cache.get(key)
+    if cached is not None and cached[0] == mtime:
+        return cached
+    names, dirs, links = [], set(), set()
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        dirs.add(entry.name)
+                    if entry.is_symlink():
+                        links.add(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        return None
+    names.sort()
+    cached = glob_cache[key] = (mtime, names, dirs, links)
+    return cached
+
+@functools.lru_cache(maxsize=256)
+def glob_segment_re(segment):
+    """Compile one /-free pattern segment, or None if it is all literal.
+
+    Backslash quotes the next character; *, ? and [...] (with ! or ^ for
+    negation) are the pattern characters.
+    """
+    out = []
+    magic = False
+    i, n = 0, len(segment)
+    while i < n:
+        c = segment[i]
+        i += 1
+        if c == "\\" and i < n:
+            out.append(re.escape(segment[i]))
+            i += 1
+        elif c == "*":
+            out.append(".*")
+            magic = True
+        elif c == "?":
+            out.append(".")
+            magic = True
+        elif c == "[":
+            j = i
+            if j < n and segment[j] in "!^":
+                j += 1
+            if j < n and segment[j] == "]":
+                j += 1
+            while j < n and segment[j] != "]":
+                j += 2 if segment[j] == "\\" else 1
+            if j >= n:
+                # No closing bracket: the [ is an ordinary character
+                out.append(re.escape(c))
+                continue
+            body, i = segment[i:j], j + 1
+            negate = body[:1] in ("!", "^")
+            if negate:
+                body = body[1:]
+            chars = []
+            k = 0
+            while k < len(body):
+                if body[k] == "\\" and k + 1 < len(body):
+                    k += 1
+                    chars.append(re.escape(body[k]))
+                else:
+                    chars.append("-" if body[k] == "-" else re.escape(body[k]))
+                k += 1
+            out.append(("[^" if negate else "[") + "".join(chars) + "]")
+            magic = True
+        else:
+            out.append(re.escape(c))
+    return re.compile("".join(out), re.DOTALL) if magic else None
+
+def join_glob_path(prefix, name):
+    return prefix + name if not prefix or prefix.endswith("/") else f"{prefix}/{name}"
+
+def glob_subdirectories(prefix):
+    """prefix and every directory below it, for **; hidden directories and
+    symlinks are not descended into, as in bash."""
+    found = [prefix]
+    for dir in found:
+        listing = list_directory(dir or ".")
+        if listing is None:
+            continue
+        _, names, dirs, links = listing
+        found.extend(join_glob_path(dir, name) for name in names
+                     if name in dirs and name not in links and not name.startswith("."))
+    return found
+
+def glob(pattern):
+    """Expand a pattern (quoted characters backslash-escaped) to sorted paths.
+
+    Literal segments are joined without reading their directory; only
+    segments with pattern characters list one, through glob_cache. A
+    leading dot must be matched explicitly, a trailing / matches only
+    directories and a ** segment matches any number of directories.
+    """
+    prefix = "/" if pattern.startswith("/") else ""
+    segments = [s for s in pattern.split("/") if s]
+    dirs_only = pattern.endswith("/")
+    paths = [prefix]
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == "**":
+            dirs = [d for p in paths for d in glob_subdirectories(p)]
+            if not last:
+                paths = dirs
+                continue
+            # A final ** matches the directory itself and everything below
+            paths = [p if dirs_only else join_glob_path(p, "") for p in paths if p]
+            for dir in dirs:
+                listing = list_directory(dir or ".")
+                if listing is not None:
+                    paths.extend(join_glob_path(dir, name) for name in listing[1]
+                                 if not name.startswith(".") and (not dirs_only or name in listing[2]))
+            continue
+        regex = glob_segment_re(segment)
+        if regex is None:
+            literal = GLOB_ESCAPE_RE.sub(r"\1", segment)
+            paths = [join_glob_path(p, literal) for p in paths]
+            if last:
+                check = os.path.isdir if dirs_only else os.path.lexists
+                paths = [p for p in paths if check(p)]
+            continue
+        hidden = segment.startswith(".")
+        matched = []
+        for p in paths:
+            listing = list_directory(p or ".")
+            if listing is None:
+                continue
+            _, names, dirs, _ = listing
+            need_dir = not last or dirs_only
+            matched.extend(join_glob_path(p, name) for name in names
+                           if (hidden or not name.startswith(".")) and (not need_dir or name in dirs)
+                           and regex.fullmatch(name))
+        paths = matched
+    if dirs_only:
+        paths = [p + "/" for p in paths if p != "/"]
+    return sorted(paths)
+
+IFS_RE = re.compile(r"[ \t\n]+")
+
+def expand_part(kind, value):
+    if kind == "text":
+        return value
+    if kind == "param":
+        return param_value(value)
+    return command_substitution(value)
+
+def expand_value(word):
+    """Expand a word to one string, without field splitting or globbing.
+
+    Used for assignment values and redirection targets.
+    """
+    if not isinstance(word, Word):
+        return word
+    return "".join(expand_part(kind, value) for kind, value, _ in word.parts)
+
+def expand_fields(word):
+    """Expand a Word's parts and split the unquoted results on whitespace.
+
+    Returns the fields as lists of (text, quoted) pieces, so quoted pattern
+    characters can still be told apart when the fields are globbed.
+    """
+    fields = []
+    field = None
+    for kind, value, quoted in word.parts:
+        if kind == "param" and value == "@" and quoted:
+            # "$@" is one field per positional parameter, and none at all
+            # when there are none
+            for i, arg in enumerate(shell_state["positional"]):
+                if i > 0:
+                    fields.append(field)
+                    field = None
+                field = (field or []) + [(arg, True)]
+            continue
+        text = expand_part(kind, value)
+        if kind == "text" or quoted:
+            field = (field or []) + [(text, quoted)]
+            continue
+        for i, piece in enumerate(IFS_RE.split(text) if text else ()):
+            if i > 0 and field is not None:
+                fields.append(field)
+                field = None
+            if piece:
+                field = (field or []) + [(piece, False)]
+    if field is not None:
+        fields.append(field)
+    return fields
+
+def expand_words(argv):
+    """Expand a command's words: parameters, $(...), field splitting and globs.
+
+    Plain str words pass through untouched. A field with unquoted pattern
+    characters becomes its sorted matches or, when nothing matches, itself
+    with quotes removed, as in POSIX sh.
+    """
+    words = []
+    for word in argv:
+        if not isinstance(word, Word):
+            words.append(word)
+        elif not word.split:
+            words.append(expand_value(word))
+        else:
+            for field in expand_fields(word):
+                if len(field) == 1 and (field[0][1] or not GLOB_MAGIC_RE.search(field[0][0])):
+                    words.append(field[0][0])
+                    continue
+                text = "".join(text for text, _ in field)
+                if any(not quoted and GLOB_MAGIC_RE.search(piece) for piece, quoted in field):
+                    pattern = "".join(GLOB_SPECIAL_RE.sub(r"\\\1", piece) if quoted else piece
+                                      for piece, quoted in field)
+                    words.extend(glob(pattern) or [text])
+                else:
+                    words.append(text)
+    return words
+
+# How long the first TAB in a directory waits for its listing before giving
+# up for this press; the scan carries on in the background for the next one
+COMPLETION_WAIT = 0.1
+
+# Background listing threads by directory key, at most one per directory
+completion_scans = {}
+
+def prefetch_directory(path):
+    """Start reading path's listing into glob_cache on a background thread."""
+    key = directory_key(path)
+    thread = completion_scans.get(key)
+    if thread is None or not thread.is_alive():
+        thread = threading.Thread(target=list_directory, args=(key,), daemon=True)
+        completion_scans[key] = thread
+        thread.start()
+    return thread
+
+def completion_listing(path):
+    """A directory listing for completion, without blocking the prompt.
+
+    A cached listing is used at once and revalidated in the background; an
+    uncached one is waited for only briefly, returning None if the scan is
+    still running.
+    """
+    cached = glob_cache.get(directory_key(path))
+    thread = prefetch_directory(path)
+    if cached is not None:
+        return cached
+    thread.join(COMPLETION_WAIT)
+    return glob_cache.get(directory_key(path))
+
+def get_path_completions(text, dirs_only=False):
+    """Paths starting with text, directories ending in /; None while loading."""
+    prefix = text[text.rfind("/") + 1:]
+    head = text[:len(text) - len(prefix)]
+    listing = completion_listing(os.path.expanduser(head) or ".")
+    if listing is None:
+        return None
+    _, names, dirs, _ = listing
+    completions = []
+    for i in range(bisect.bisect_left(names, prefix), len(names)):
+        name = names[i]
+        if not name.startswith(prefix):
+            break
+        if name.startswith(".") and not prefix.startswith("."):
             continue
-    return sorted(completions)
+        if name in dirs:
+            completions.append(head + name + "/")
+        elif not dirs_only:
+            completions.append(head + name)
+    return completions
+
+def completion_context(before):
+    """What the word being completed is: "command", "directory" (after cd) or "file".
+
+    before is the line up to the start of that word.
+    """
+    if re.search(r"[<>]\s*$", before):
+        return "file"
+    words = re.split(r"[;&|]", before)[-1].split()
+    if words[:1] == ["time"]:
+        words = words[1:]
+    if not words:
+        return "command"
+    return "directory" if words[0] == "cd" else "file"
+
+def get_completions(text):
+    context = completion_context(readline.get_line_buffer()[:readline.get_begidx()])
+    if context == "command" and "/" not in text:
+        return get_executable_completions(text)
+    return get_path_completions(text, dirs_only=context == "directory")
 
 def longest_common_prefix(strings):
     if not strings:
@@ -46,33 +617,38 @@ def longest_common_prefix(strings):
 
 def completer(text, state):
     global tab_state
-    matches = get_executable_completions(text)
-    # Track tab presses and prefix
-    if tab_state["last_prefix"] != text:
-        tab_state["last_prefix"] = text
+    # readline calls us with state 0, 1, 2... for one TAB press and we only
+    # ever offer one completion, so just the first call does any work.
+    if state > 0:
+        return None
+    # Track tab presses and prefix; a repeated TAB on the same word reuses
+    # the matches found by the previous press.
+    key = (readline.get_begidx(), text)
+    if tab_state["last_prefix"] != key:
+        matches = get_completions(text)
+        if matches is None:
+            # The directory is still being read; the next TAB looks again
+            tab_state["last_prefix"] = None
+            return None
+        tab_state["last_prefix"] = key
         tab_state["tab_count"] = 1
         tab_state["matches"] = matches
     else:
         tab_state["tab_count"] += 1
+    matches = tab_state["matches"]
 
     if not matches:
         return None
 
-    # If only one match, complete to it
+    # If only one match, complete to it; a directory stays open for more
     if len(matches) == 1:
         tab_state["tab_count"] = 0
-        if state == 0:
-            return matches[0] + " "
-        else:
-            return None
+        return matches[0] if matches[0].endswith("/") else matches[0] + " "
 
     # Multiple matches: complete to longest common prefix
     lcp = longest_common_prefix(matches)
     if lcp and lcp != text:
-        if state == 0:
-            return lcp
-        else:
-            return None
+        return lcp
 
     # If no further completion, handle bell and list as before
     if tab_state["tab_count"] == 1:
@@ -80,470 +656,3420 @@ def completer(text, state):
         sys.stdout.flush()
         return None
     elif tab_state["tab_count"] == 2:
-        sys.stdout.write("\n" + "  ".join(matches) + "\n$ " + text)
+        names = [m[m.rstrip("/").rfind("/") + 1:] for m in matches]
+        sys.stdout.write("\n" + "  ".join(names) + "\n$ " + readline.get_line_buffer())
         sys.stdout.flush()
         tab_state["tab_count"] = 0
         return None
     else:
         return None
 
-def run_builtin(cmd, args, inp=None, out=None):
-    # Save original stdin/stdout
-    orig_in, orig_out = sys.stdin, sys.stdout
-    if inp:
-        sys.stdin = inp
-    if out:
-        sys.stdout = out
-    try:
-        if cmd == "echo":
-            print(" ".join(args))
-        elif cmd == "pwd":
-            print(shutil.os.getcwd())
-        elif cmd == "type":
-            if args:
-                arg_cmd = str(args[0])
-                if arg_cmd in builtins:
-                    print(f"{arg_cmd} is a shell builtin")
-                elif p := shutil.which(arg_cmd):
-                    print(f"{arg_cmd} is {p}")
-                else:
-                    print(f"{arg_cmd}: not found")
-            else:
-                print("argument required after type command")
-        elif cmd == "exit":
-            status = 0
-            if args:
-                try:
-                    status = int(args[0])
-                except ValueError:
-                    print(f"exit: {args[0]}: numeric argument required", file=sys.stderr)
-                    status = 1
-            sys.exit(status)
-        elif cmd == "cd":
-            if args:
-                target = args[0]
-                if target == "~":
-                    target = os.environ.get("HOME", "")
-                try:
-                    shutil.os.chdir(target)
-                except FileNotFoundError:
-                    print(f"cd: {args[0]}: No such file or directory", file=sys.stderr)
-                except PermissionError:
-                    print(f"cd: {args[0]}: Permission denied", file=sys.stderr)
+# Size of the reusable buffers used when builtins move data between fds
+IO_CHUNK = 1 << 16
+
+# Read size for scripts and seekable stdin in batch mode
+BATCH_BUFFER = 1 << 20
+
+class FdWriter:
+    """Buffered binary writer over a raw file descriptor.
+
+    Builtins write str or bytes; str is encoded with surrogateescape so
+    arguments that were not valid UTF-8 come back out byte-exact. Output
+    collects in one reusable bytearray and goes to the fd with os.write
+    through a memoryview, so a flush never copies the buffer.
+    """
+
+    def __init__(self, fd, closefd=False):
+        self.fd = fd
+        self.closefd = closefd
+        self.buf = bytearray()
+        self.bytes_written = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8", "surrogateescape")
+        if not self.buf and len(data) >= IO_CHUNK:
+            # Big writes skip the buffer entirely
+            self.write_all(data)
+            return len(data)
+        self.buf += data
+        if len(self.buf) >= IO_CHUNK:
+            self.flush()
+        return len(data)
+
+    def write_all(self, data):
+        with memoryview(data) as view:
+            pos = 0
+            try:
+                while pos < len(view):
+                    pos += os.write(self.fd, view[pos:])
+            finally:
+                self.bytes_written += pos
+
+    def flush(self):
+        if self.buf:
+            try:
+                self.write_all(self.buf)
+            finally:
+                # Dropped even when the write fails, so that closing after
+                # an error does not fail the same way again
+                del self.buf[:]
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.closefd:
+                os.close(self.fd)
+
+# Bytes a BufferWriter keeps in memory before it spills to disk;
+# PYSH_SPILL_BYTES overrides it
+SPILL_LIMIT = 4 << 20
+
+# Temporary files BufferWriters have spilled to, and the bytes written to
+# them, over the life of the shell; reported in the trace
+spill_stats = {"files": 0, "bytes": 0}
+
+def spill_limit():
+    value = os.environ.get("PYSH_SPILL_BYTES", "")
+    return int(value) if value.isdigit() else SPILL_LIMIT
+
+class BufferWriter:
+    """FdWriter stand-in that keeps everything written.
+
+    Up to limit bytes stay in memory. Past that, they and everything after
+    go to an unlinked temporary file through an FdWriter, so however much
+    is written the buffer holds at most IO_CHUNK more in memory. view()
+    maps a spilled file back read-only instead of reading it in.
+    """
+
+    def __init__(self, limit=None):
+        self.buf = bytearray()
+        self.limit = spill_limit() if limit is None else limit
+        self.file = None
+        self.spill = None  # FdWriter over the temporary file once spilled
+        self.map = None
+        self.bytes_written = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8", "surrogateescape")
+        if self.spill is None and len(self.buf) + len(data) > self.limit:
+            self.start_spill()
+        if self.spill is None:
+            self.buf += data
+        else:
+            self.spill.write(data)
+            spill_stats["bytes"] += len(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def start_spill(self):
+        import tempfile
+        self.file = tempfile.TemporaryFile()
+        self.spill = FdWriter(self.file.fileno())
+        spill_stats["files"] += 1
+        spill_stats["bytes"] += len(self.buf)
+        self.spill.write(self.buf)
+        self.buf = bytearray()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def view(self):
+        """A memoryview of everything written, mapped from the temporary
+        file if it spilled. Release it before calling release()."""
+        if self.spill is None:
+            return memoryview(self.buf)
+        self.spill.flush()
+        if self.map is None:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self.map)
+
+    def write_to(self, writer):
+        """Write everything to writer, then release the buffer.
+
+        A spilled file is written a window at a time straight from the
+        mapping, each window's pages dropped once written, so the copy
+        never holds more than one window in memory.
+        """
+        with self.view() as view:
+            if self.map is None or not hasattr(mmap, "MADV_DONTNEED"):
+                writer.write(view)
             else:
-                print("cd: missing argument", file=sys.stderr)
+                for pos in range(0, len(view), BATCH_BUFFER):
+                    writer.write(view[pos:pos + BATCH_BUFFER])
+                    self.map.madvise(mmap.MADV_DONTNEED, pos, min(BATCH_BUFFER, len(view) - pos))
+        self.release()
+
+    def release(self):
+        """Free the memory or temporary file behind the buffer."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = self.spill = None
+        self.buf = bytearray()
+
+def copy_fd(src_fd, dst_fd):
+    """Copy src_fd to EOF into dst_fd and return the number of bytes moved.
+
+    The kernel does the copy where it can: splice(2) when either side is a
+    pipe and sendfile(2) from a regular file. Otherwise data goes through
+    one reusable buffer with no per-chunk allocation. An OSError, such as
+    the reader going away, carries the bytes moved before it as .copied.
+    """
+    total = 0
+    try:
+        if hasattr(os, "splice"):
+            try:
+                while n := os.splice(src_fd, dst_fd, IO_CHUNK):
+                    total += n
+                return total
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS) or total:
+                    raise
+        if hasattr(os, "sendfile"):
+            try:
+                while n := os.sendfile(dst_fd, src_fd, None, IO_CHUNK):
+                    total += n
+                return total
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS) or total:
+                    raise
+        buf = bytearray(IO_CHUNK)
+        with memoryview(buf) as view:
+            while n := os.readv(src_fd, [buf]):
+                pos = 0
+                while pos < n:
+                    written = os.write(dst_fd, view[pos:n])
+                    pos += written
+                    total += written
+        return total
+    except OSError as e:
+        e.copied = total
+        raise
+
+# In-process versions of the utilities that dominate short pipelines. Each
+# entry is (argument parser, runner); the parser returns None for anything
+# it does not handle so the stage falls back to the real binary.
+def native_utils_enabled():
+    return os.environ.get("PYSH_NATIVE_UTILS", "1") != "0"
+
+def use_native_util(cmd, args):
+    return cmd in native_utils and native_utils_enabled() and native_utils[cmd][0](args) is not None
+
+def open_input(cmd, name, inp, err, message="{name}: {reason}"):
+    """Return (fd, owned) for an input operand, or None after reporting an error."""
+    if name == "-":
+        return (0 if inp is None else inp), False
+    try:
+        return os.open(name, os.O_RDONLY), True
+    except OSError as e:
+        print(f"{cmd}: " + message.format(name=name, reason=e.strerror), file=err)
+        return None
+
+def parse_cat_args(args):
+    if any(a.startswith("-") and a != "-" for a in args):
+        return None
+    return args or ["-"]
+
+def native_cat(args, inp, out, err):
+    status = 0
+    out.flush()
+    for name in parse_cat_args(args):
+        opened = open_input("cat", name, inp, err)
+        if opened is None:
+            status = 1
+            continue
+        fd, owned = opened
+        try:
+            out.bytes_written += copy_fd(fd, out.fd)
+        except OSError as e:
+            # Count what reached the reader before it went away
+            out.bytes_written += e.copied
+            raise
+        finally:
+            if owned:
+                os.close(fd)
+    return status
+
+def parse_lines_args(args):
+    """Parse head/tail arguments: [-n N | -nN | -N] [file]."""
+    count = 10
+    files = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        i += 1
+        if arg == "-n" and i < len(args):
+            value = args[i]
+            i += 1
+        elif arg.startswith("-n"):
+            value = arg[2:]
+        elif arg.startswith("-") and arg[1:].isdigit():
+            value = arg[1:]
+        elif arg.startswith("-") and arg != "-":
+            return None
+        else:
+            files.append(arg)
+            continue
+        if not value.isdigit():
+            return None
+        count = int(value)
+    if len(files) > 1:
+        return None
+    return count, files[0] if files else "-"
+
+def native_head(args, inp, out, err):
+    count, name = parse_lines_args(args)
+    opened = open_input("head", name, inp, err, "cannot open '{name}' for reading: {reason}")
+    if opened is None:
+        return 1
+    fd, owned = opened
+    try:
+        remaining = count
+        while remaining and (chunk := os.read(fd, IO_CHUNK)):
+            end = 0
+            while remaining:
+                nl = chunk.find(b"\n", end)
+                if nl < 0:
+                    end = len(chunk)
+                    break
+                end = nl + 1
+                remaining -= 1
+            out.write(chunk if end == len(chunk) else chunk[:end])
     finally:
-        sys.stdin, sys.stdout = orig_in, orig_out
+        if owned:
+            os.close(fd)
+    return 0
 
-def run_pipeline(commands, builtins):
-    """Run a pipeline of commands, handling built-ins and externals."""
-    n = len(commands)
-    prev_output = None  # For input to the next command
+def last_lines_start(buf, count):
+    """Offset in buf where its last count lines begin."""
+    if count == 0:
+        return len(buf)
+    pos = len(buf) - 1 if buf.endswith(b"\n") else len(buf)
+    for _ in range(count):
+        pos = buf.rfind(b"\n", 0, pos)
+        if pos < 0:
+            return 0
+    return pos + 1
+
+def native_tail(args, inp, out, err):
+    count, name = parse_lines_args(args)
+    opened = open_input("tail", name, inp, err, "cannot open '{name}' for reading: {reason}")
+    if opened is None:
+        return 1
+    fd, owned = opened
+    buf = bytearray()
+    try:
+        while chunk := os.read(fd, IO_CHUNK):
+            buf += chunk
+            # Only the last count lines can ever be printed
+            if len(buf) > 4 * IO_CHUNK:
+                del buf[:last_lines_start(buf, count)]
+    finally:
+        if owned:
+            os.close(fd)
+    out.write(memoryview(buf)[last_lines_start(buf, count):])
+    return 0
+
+def parse_wc_args(args):
+    flags = ""
+    for arg in args:
+        if len(arg) < 2 or arg[0] != "-" or not set(arg[1:]) <= set("lwc"):
+            return None
+        flags += arg[1:]
+    return [f for f in "lwc" if f in flags] if flags else ["l", "w", "c"]
 
-    for i, cmd_parts in enumerate(commands):
-        cmd = cmd_parts[0]
-        args = cmd_parts[1:]
-        is_builtin = cmd in builtins
+def native_wc(args, inp, out, err):
+    flags = parse_wc_args(args)
+    fd = 0 if inp is None else inp
+    counts = {"l": 0, "w": 0, "c": 0}
+    in_word = False
+    while chunk := os.read(fd, IO_CHUNK):
+        counts["c"] += len(chunk)
+        counts["l"] += chunk.count(b"\n")
+        if "w" in flags:
+            counts["w"] += len(chunk.split())
+            # A word split across two reads was counted twice
+            if in_word and not chunk[:1].isspace():
+                counts["w"] -= 1
+            in_word = not chunk[-1:].isspace()
+    if len(flags) == 1:
+        print(counts[flags[0]], file=out)
+    else:
+        print(" ".join(f"{counts[f]:7d}" for f in flags), file=out)
+    return 0
 
-        # If not last command, prepare a buffer for output
-        if i < n - 1:
-            buf = io.StringIO()
-            out = buf
+def parse_grep_args(args):
+    """Parse grep [-Fvci] PATTERN [file] for fixed-string patterns only."""
+    opts = set()
+    pattern = None
+    files = []
+    for arg in args:
+        if arg.startswith("-") and len(arg) > 1:
+            if pattern is not None or not set(arg[1:]) <= set("Fvci"):
+                return None
+            opts.update(arg[1:])
+        elif pattern is None:
+            pattern = arg
         else:
-            out = sys.stdout
+            files.append(arg)
+    if not pattern or "\n" in pattern or len(files) > 1:
+        return None
+    # Without -F the pattern is a basic regex, which is only a fixed string
+    # when it contains none of the BRE metacharacters
+    if "F" not in opts and any(c in pattern for c in ".[]*^$\\"):
+        return None
+    if "i" in opts and not pattern.isascii():
+        return None
+    return opts, pattern.encode("utf-8", "surrogateescape"), files[0] if files else "-"
+
+def grep_block(block, needle, opts, out):
+    """Write the matching lines of a block of complete lines; return the count."""
+    hay = block.lower() if "i" in opts else block
+    count_only = "c" in opts
+    matched = 0
+    if "v" in opts:
+        lines = block.split(b"\n")
+        for line, hline in zip(lines, hay.split(b"\n")[:-1]):
+            if needle not in hline:
+                matched += 1
+                if not count_only:
+                    out.write(line + b"\n")
+        return matched
+    # Jump from match to match instead of testing every line
+    start = 0
+    while (pos := hay.find(needle, start)) >= 0:
+        line_start = hay.rfind(b"\n", 0, pos) + 1
+        start = hay.find(b"\n", pos) + 1
+        matched += 1
+        if not count_only:
+            out.write(block[line_start:start])
+    return matched
 
-        inp = prev_output
+def native_grep(args, inp, out, err):
+    opts, needle, name = parse_grep_args(args)
+    if "i" in opts:
+        needle = needle.lower()
+    opened = open_input("grep", name, inp, err)
+    if opened is None:
+        return 2
+    fd, owned = opened
+    matched = 0
+    partial = b""
+    try:
+        while chunk := os.read(fd, IO_CHUNK):
+            data = partial + chunk if partial else chunk
+            cut = data.rfind(b"\n") + 1
+            partial = data[cut:]
+            if cut:
+                matched += grep_block(data[:cut], needle, opts, out)
+        if partial:
+            matched += grep_block(partial + b"\n", needle, opts, out)
+    finally:
+        if owned:
+            os.close(fd)
+    if "c" in opts:
+        print(matched, file=out)
+    return 0 if matched else 1
 
-        if is_builtin:
-            # For built-ins, use run_builtin with inp/out
-            run_builtin(cmd, args, inp=inp, out=out)
+native_utils = {
+    "cat": (parse_cat_args, native_cat),
+    "head": (parse_lines_args, native_head),
+    "tail": (parse_lines_args, native_tail),
+    "wc": (parse_wc_args, native_wc),
+    "grep": (parse_grep_args, native_grep),
+}
+
+def parse_parallel_args(args, err):
+    """Parse [-j N] [-k] [--halt never|soon|now] command... [::: items...]."""
+    opts = {"jobs": os.cpu_count() or 1, "keep_order": False, "halt": "never"}
+    i = 0
+    while i < len(args) and args[i].startswith("-"):
+        arg = args[i]
+        i += 1
+        if arg in ("-k", "--keep-order"):
+            opts["keep_order"] = True
+            continue
+        if arg in ("-j", "--jobs", "--halt"):
+            if i == len(args):
+                print(f"parallel: {arg}: option requires an argument", file=err)
+                return None
+            value = args[i]
+            i += 1
+        elif arg.startswith("-j"):
+            value = arg[2:]
+        else:
+            print(f"parallel: {arg}: invalid option", file=err)
+            return None
+        if arg == "--halt":
+            if value not in ("never", "soon", "now"):
+                print(f"parallel: --halt: {value}: expected never, soon or now", file=err)
+                return None
+            opts["halt"] = value
+        elif not value.isdigit() or int(value) < 1:
+            print(f"parallel: {arg}: {value}: invalid number of jobs", file=err)
+            return None
         else:
-            # For externals, use subprocess
-            stdin = inp if inp is None else subprocess.PIPE
-            stdout = out if out != sys.stdout else None
-            if inp:
-                # Read input from inp and pass to process
-                p = subprocess.Popen([cmd] + args, stdin=subprocess.PIPE, stdout=stdout)
-                input_bytes = inp.read().encode()
-                out_bytes, _ = p.communicate(input=input_bytes)
-                if out != sys.stdout and out is not None and out_bytes is not None:
-                    out.write(out_bytes.decode())
+            opts["jobs"] = int(value)
+    rest = args[i:]
+    if ":::" in rest:
+        split = rest.index(":::")
+        opts["template"], opts["items"] = rest[:split], rest[split + 1:]
+    else:
+        opts["template"], opts["items"] = rest, None
+    if not opts["template"]:
+        print("parallel: missing command", file=err)
+        return None
+    return opts
+
+def read_items(fd):
+    """Yield non-empty input lines from fd as they arrive."""
+    with open(fd, "rb", buffering=IO_CHUNK, closefd=False) as stream:
+        for line in stream:
+            item = line.rstrip(b"\n").decode("utf-8", "surrogateescape")
+            if item:
+                yield item
+
+def expand_template(template, item):
+    """Substitute item for {}, appending it when the template has no {}."""
+    if not any("{}" in word for word in template):
+        return template + [item]
+    return [word.replace("{}", item) for word in template]
+
+def halt_parallel(halt, halted, running):
+    """Apply the --halt policy after a job fails."""
+    if halt == "never":
+        return
+    halted.set()
+    if halt == "now":
+        for proc in list(running):
+            try:
+                os.kill(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+def run_parallel_job(argv, halt, halted, running, err):
+    """Run one parallel job with its stdout captured; returns (status, output,
+    errors) with the output and the shell's own messages in BufferWriters.
+
+    err is the parallel builtin's stderr. Externals write to its fd
+    directly; a builtin's messages are kept in errors for the calling
+    thread to write, since workers never share a writer.
+    """
+    errors = BufferWriter()
+    if halted.is_set():
+        return None, BufferWriter(), errors
+    status, output = run_parallel_command(argv, running, err, errors)
+    if status != 0:
+        halt_parallel(halt, halted, running)
+    return status, output, errors
+
+def run_parallel_command(argv, running, err, errors):
+    """Run one job. Like GNU parallel's, jobs read /dev/null rather than the
+    shell's stdin, which they would otherwise race each other for."""
+    cmd, args = argv[0], argv[1:]
+    if cmd in state_builtins:
+        # Jobs run on worker threads of the shell itself, where these would
+        # change (and race on) the shell's own state
+        print(f"parallel: {cmd}: cannot run a builtin that changes the shell", file=errors)
+        return 1, BufferWriter()
+    output = BufferWriter()
+    stdin = os.open(os.devnull, os.O_RDONLY)
+    try:
+        if cmd in builtins:
+            # Builtins run on this worker thread and write straight into memory
+            try:
+                status = run_builtin(cmd, args, inp=stdin, out=output, err=errors)
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            return status, output
+        executable = find_executable(cmd)
+        if not executable:
+            print(f"{cmd}: command not found", file=errors)
+            return 127, output
+        read_fd, write_fd = os.pipe()
+        # A stderr without an fd of its own is a capture buffer that 2>&1
+        # made the same as stdout, so the job's stderr joins its output
+        stderr = err.fd if isinstance(err, FdWriter) else write_fd
+        try:
+            proc = launch(argv, executable, stdin=stdin, stdout=write_fd, stderr=stderr)
+        except OSError as e:
+            os.close(read_fd)
+            print(f"Error executing {cmd}: {e}", file=errors)
+            return 126, output
+        finally:
+            os.close(write_fd)
+    finally:
+        os.close(stdin)
+    running.add(proc)
+    try:
+        drain_fd(read_fd, output)
+    finally:
+        os.close(read_fd)
+    status = exit_status(proc.wait())
+    running.discard(proc)
+    return status, output
+
+def parallel_builtin(args, inp, out, err):
+    """Run a command once per input item on a bounded pool of workers.
+
+    Each job's stdout is buffered and written in one piece, so output from
+    different jobs never interleaves; -k writes it in input order. --halt
+    soon stops starting jobs after the first failure and --halt now also
+    terminates the jobs still running.
+    """
+    import concurrent.futures
+    opts = parse_parallel_args(args, err)
+    if opts is None:
+        return 2
+    items = opts["items"] if opts["items"] is not None else read_items(0 if inp is None else inp)
+    halted = threading.Event()
+    running = set()
+    results = {}  # Finished jobs waiting for their turn with -k
+    next_index = 0
+    failed = 0
+    first_failure = None
+
+    def emit(index, status, output, errors):
+        nonlocal next_index, failed, first_failure
+        if status is not None and status != 0:
+            failed += 1
+            if first_failure is None:
+                first_failure = status
+        if not opts["keep_order"]:
+            output.write_to(out)
+            errors.write_to(err)
+            out.flush()
+            err.flush()
+            return
+        results[index] = output, errors
+        while next_index in results:
+            output, errors = results.pop(next_index)
+            output.write_to(out)
+            errors.write_to(err)
+            next_index += 1
+        out.flush()
+        err.flush()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opts["jobs"]) as pool:
+        pending = {}
+        for index, item in enumerate(items):
+            if halted.is_set():
+                break
+            argv = expand_template(opts["template"], item)
+            pending[pool.submit(run_parallel_job, argv, opts["halt"], halted, running, err)] = index
+            # Keep at most one queued job per worker so items are read lazily
+            while len(pending) >= 2 * opts["jobs"]:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    emit(pending.pop(future), *future.result())
+        for future in concurrent.futures.as_completed(list(pending)):
+            emit(pending.pop(future), *future.result())
+    if opts["halt"] != "never":
+        return first_failure or 0
+    return min(failed, 101)
+
+def test_integer(text):
+    try:
+        return int(text.strip())
+    except ValueError:
+        raise ValueError(f"{text}: integer expression expected") from None
+
+# Unary and binary operators of test and [
+TEST_UNARY = {
+    "-n": lambda s: s != "",
+    "-z": lambda s: s == "",
+    "-e": os.path.exists,
+    "-f": os.path.isfile,
+    "-d": os.path.isdir,
+    "-L": os.path.islink,
+    "-h": os.path.islink,
+    "-s": lambda s: os.path.isfile(s) and os.path.getsize(s) > 0,
+    "-r": lambda s: os.access(s, os.R_OK),
+    "-w": lambda s: os.access(s, os.W_OK),
+    "-x": lambda s: os.access(s, os.X_OK),
+}
+
+TEST_BINARY = {
+    "=": lambda a, b: a == b,
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "-eq": lambda a, b: test_integer(a) == test_integer(b),
+    "-ne": lambda a, b: test_integer(a) != test_integer(b),
+    "-lt": lambda a, b: test_integer(a) < test_integer(b),
+    "-le": lambda a, b: test_integer(a) <= test_integer(b),
+    "-gt": lambda a, b: test_integer(a) > test_integer(b),
+    "-ge": lambda a, b: test_integer(a) >= test_integer(b),
+}
+
+def evaluate_test(args):
+    """Evaluate test's arguments by their count, as POSIX specifies.
+
+    Raises ValueError with the message for malformed expressions.
+    """
+    if not args:
+        return False
+    if len(args) == 1:
+        return args[0] != ""
+    if len(args) == 2:
+        if args[0] == "!":
+            return not evaluate_test(args[1:])
+        if args[0] in TEST_UNARY:
+            return TEST_UNARY[args[0]](args[1])
+        raise ValueError(f"{args[0]}: unary operator expected")
+    if len(args) == 3:
+        if args[1] in TEST_BINARY:
+            return TEST_BINARY[args[1]](args[0], args[2])
+        if args[0] == "!":
+            return not evaluate_test(args[1:])
+        if args[0] == "(" and args[2] == ")":
+            return evaluate_test(args[1:2])
+        raise ValueError(f"{args[1]}: binary operator expected")
+    if len(args) == 4 and args[0] == "!":
+        return not evaluate_test(args[1:])
+    raise ValueError("too many arguments")
+
+def test_builtin(cmd, args, err):
+    if cmd == "[":
+        if not args or args[-1] != "]":
+            print("[: missing `]'", file=err)
+            return 2
+        args = args[:-1]
+    try:
+        return 0 if evaluate_test(args) else 1
+    except ValueError as e:
+        print(f"{cmd}: {e}", file=err)
+        return 2
+
+class ControlFlow(Exception):
+    """break, continue or return, unwinding to the loop or function it ends.
+
+    count is the number of loops left to leave for break and continue, and
+    the exit status for return.
+    """
+
+    def __init__(self, kind, count):
+        super().__init__(kind)
+        self.kind = kind
+        self.count = count
+
+def control_flow_builtin(cmd, args, err):
+    if cmd == "return":
+        if not shell_state["locals"]:
+            print("return: can only `return' from a function", file=err)
+            return 1
+        status = shell_state["last_status"]
+        if args:
+            try:
+                status = int(args[0]) & 0xFF
+            except ValueError:
+                print(f"return: {args[0]}: numeric argument required", file=err)
+                status = 2
+        raise ControlFlow("return", status)
+    if not shell_state["loop_depth"]:
+        print(f"{cmd}: only meaningful in a `for', `while', or `until' loop", file=err)
+        return 0
+    count = 1
+    if args:
+        try:
+            count = int(args[0])
+        except ValueError:
+            print(f"{cmd}: {args[0]}: numeric argument required", file=err)
+            return 1
+        if count < 1:
+            print(f"{cmd}: {args[0]}: loop count out of range", file=err)
+            return 1
+    raise ControlFlow(cmd, min(count, shell_state["loop_depth"]))
+
+def run_builtin(cmd, args, inp=None, out=None, err=None):
+    """Run a builtin against explicit streams and return its exit status.
+
+    inp is a raw fd; out and err are anything with a write method, normally
+    FdWriters. Nothing process-global is swapped, so builtins can run on
+    pipeline threads while other stages are writing to the terminal.
+    """
+    out = out or sys.stdout
+    err = err or sys.stderr
+    if cmd == "echo":
+        print(" ".join(args), file=out)
+    elif cmd == "pwd":
+        print(os.getcwd(), file=out)
+    elif cmd == "type":
+        if args:
+            arg_cmd = str(args[0])
+            if arg_cmd in shell_keywords:
+                print(f"{arg_cmd} is a shell keyword", file=out)
+            elif arg_cmd in shell_functions:
+                print(f"{arg_cmd} is a function", file=out)
+                print(f"{arg_cmd} () {format_compound(shell_functions[arg_cmd])}", file=out)
+            elif arg_cmd in builtins:
+                print(f"{arg_cmd} is a shell builtin", file=out)
+            elif p := find_executable(arg_cmd):
+                print(f"{arg_cmd} is {p}", file=out)
             else:
-                p = subprocess.Popen([cmd] + args, stdout=stdout)
-                out_bytes, _ = p.communicate()
-                if out != sys.stdout and out is not None and out_bytes is not None:
-                    out.write(out_bytes.decode())
-
-        # Prepare input for next command
-        if i < n - 1:
-            if out is sys.stdout:
-                # Should not happen, but just in case
-                prev_output = None
+                print(f"{arg_cmd}: not found", file=out)
+                return 1
+        else:
+            print("argument required after type command", file=out)
+            return 1
+    elif cmd == "exit":
+        status = 0
+        if args:
+            try:
+                status = int(args[0])
+            except ValueError:
+                print(f"exit: {args[0]}: numeric argument required", file=err)
+                status = 1
+        sys.exit(status)
+    elif cmd == "cd":
+        if args:
+            target = args[0]
+            if target == "~":
+                target = os.environ.get("HOME", "")
+            try:
+                os.chdir(target)
+            except FileNotFoundError:
+                print(f"cd: {args[0]}: No such file or directory", file=err)
+                return 1
+            except PermissionError:
+                print(f"cd: {args[0]}: Permission denied", file=err)
+                return 1
+        else:
+            print("cd: missing argument", file=err)
+            return 1
+    elif cmd == "hash":
+        return hash_builtin(args, out, err)
+    elif cmd == "jobs":
+        return jobs_builtin(args, out, err)
+    elif cmd == "wait":
+        return wait_builtin(args, out, err)
+    elif cmd == "fg":
+        return fg_builtin(args, out, err)
+    elif cmd == "bg":
+        return bg_builtin(args, out, err)
+    elif cmd == "kill":
+        return kill_builtin(args, out, err)
+    elif cmd == "parallel":
+        return parallel_builtin(args, inp, out, err)
+    elif cmd == "history":
+        return history_builtin(args, out, err)
+    elif cmd == "export":
+        return export_builtin(args, out, err)
+    elif cmd == "unset":
+        return unset_builtin(args, out, err)
+    elif cmd == "local":
+        return local_builtin(args, out, err)
+    elif cmd == "false":
+        return 1
+    elif cmd in ("test", "["):
+        return test_builtin(cmd, args, err)
+    elif cmd in ("break", "continue", "return"):
+        return control_flow_builtin(cmd, args, err)
+    elif cmd in native_utils:
+        return native_utils[cmd][1](args, inp, out, err)
+    return 0
+
+def exit_status(returncode):
+    """Map a Popen returncode to a shell status (128+N for signal N)."""
+    return 128 - returncode if returncode < 0 else returncode
+
+# Per-thread CPU accounting for builtin stages where the OS provides it
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+# Flags for the files named by >, >> and < style redirections. N>&M and
+# N<&M carry REDIRECT_DUP instead, with the fd M in place of a path.
+REDIRECT_TRUNC = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+REDIRECT_APPEND = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+REDIRECT_READ = os.O_RDONLY
+REDIRECT_DUP = None
+
+REDIRECT_MODES = {REDIRECT_TRUNC: "truncate", REDIRECT_APPEND: "append", REDIRECT_READ: "read",
+                  REDIRECT_DUP: "dup"}
+
+class SpawnedProcess:
+    """Handle for a launched child, reaped with wait4 so its rusage is kept.
+
+    popen is the subprocess.Popen object when that backend started the
+    child; it is told the returncode so it never tries to reap it again.
+    """
+
+    def __init__(self, pid, popen=None):
+        self.pid = pid
+        self.popen = popen
+        self.returncode = None
+        self.rusage = None
+
+    def reaped(self, status, rusage):
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.rusage = rusage
+        if self.popen is not None:
+            self.popen.returncode = self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            _, status, rusage = os.wait4(self.pid, 0)
+            self.reaped(status, rusage)
+        return self.returncode
+
+def launcher():
+    """The process launch backend: posix_spawn unless PYSH_LAUNCHER=subprocess."""
+    if os.environ.get("PYSH_LAUNCHER") == "subprocess" or not hasattr(os, "posix_spawn"):
+        return "subprocess"
+    return "posix_spawn"
+
+def bad_fd(fd):
+    return OSError(errno.EBADF, os.strerror(errno.EBADF), str(fd))
+
+def open_redirects(redirects, fds=None):
+    """Apply redirections to an fd table in the shell, left to right.
+
+    fds maps the command's fds to the shell fds behind them before any
+    redirection (0, 1 and 2 to themselves by default). Files are opened and
+    duplications resolved against the table as it stands at that point, so
+    ">f 2>&1" and "2>&1 >f" differ as they do in sh. Returns the final
+    table and the list of fds opened here, which the caller closes.
+    """
+    table = dict(fds or {0: 0, 1: 1, 2: 2})
+    opened = []
+    try:
+        for fd, target, flags in redirects:
+            if flags is REDIRECT_DUP:
+                if target not in table:
+                    raise bad_fd(target)
+                table[fd] = table[target]
             else:
-                out.seek(0)
-                prev_output = out
+                new_fd = os.open(target, flags, 0o666)
+                opened.append(new_fd)
+                table[fd] = new_fd
+    except OSError:
+        close_fds(opened)
+        raise
+    return table, opened
 
-def main():
-    builtins = {"echo", "exit", "type", "pwd", "cd"}
-    readline.set_completer(completer)
-    readline.parse_and_bind("tab: complete")
-    while True:
-        sys.stdout.write("$ ")
-        sys.stdout.flush()
+def close_fds(fds):
+    for fd in fds:
+        os.close(fd)
+
+def launch(argv, executable, stdin=None, stdout=None, stderr=None, redirects=(), env=None):
+    """Start an external command and return its SpawnedProcess.
+
+    stdin/stdout/stderr are fds to install as 0/1/2 (None inherits), and
+    redirects are applied on top of them in order. With posix_spawn both
+    become file actions run in the child, so the shell forks nothing, opens
+    nothing and skips subprocess's per-launch fd bookkeeping. The shell's
+    own pipe fds are close-on-exec and never leak into the child. The
+    subprocess backend resolves the table in the shell and can only pass
+    on fds 0, 1 and 2. env replaces os.environ for the child.
+    """
+    sys.stdout.flush()
+    if launcher() == "subprocess":
+        import subprocess
+        fds = {0: 0 if stdin is None else stdin, 1: 1 if stdout is None else stdout,
+               2: 2 if stderr is None else stderr}
+        table, opened = open_redirects(redirects, fds)
         try:
-            line = input()
-            tab_state["last_prefix"] = ""
-            tab_state["tab_count"] = 0
-            tab_state["matches"] = []
-            if "|" in line:
-                # Split pipeline into commands
-                pipeline_cmds = [shlex.split(seg.strip()) for seg in line.split("|")]
-                if not all(pipeline_cmds):
-                    continue
-                run_pipeline(pipeline_cmds, builtins)
-                continue
+            proc = subprocess.Popen(argv, executable=executable, stdin=table[0], stdout=table[1], stderr=table[2],
+                                    env=env)
+            return SpawnedProcess(proc.pid, popen=proc)
+        finally:
+            close_fds(opened)
+    actions = []
+    for target, fd in ((0, stdin), (1, stdout), (2, stderr)):
+        if fd is not None and fd != target:
+            actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+    valid = {0, 1, 2}
+    for fd, target, flags in redirects:
+        if flags is REDIRECT_DUP:
+            # Only fds the child is known to have; the shell's own others
+            # are close-on-exec
+            if target not in valid:
+                raise bad_fd(target)
+            if target != fd:
+                actions.append((os.POSIX_SPAWN_DUP2, target, fd))
+        else:
+            actions.append((os.POSIX_SPAWN_OPEN, fd, target, flags, 0o666))
+        valid.add(fd)
+    # Python ignores SIGPIPE and SIGXFSZ and ignored signals survive exec,
+    # so put them back to their defaults for the child.
+    pid = os.posix_spawn(executable, argv, os.environ if env is None else env, file_actions=actions,
+                         setsigdef=(signal.SIGPIPE, signal.SIGXFSZ))
+    return SpawnedProcess(pid)
 
-            parts = shlex.split(line, posix=True)
-            if not parts:
-                continue
+def report_launch_error(message, redirects=()):
+    """Report a failed launch where the child's stderr would have gone.
 
-            # Output redirection support
-            if ">" in parts or "1>" in parts:
-                if ">" in parts:
-                    op_index = parts.index(">")
-                else:
-                    op_index = parts.index("1>")
-                cmd_parts = parts[:op_index]
-                outfile = parts[op_index + 1] if len(parts) > op_index + 1 else None
-                if not outfile:
-                    print("No output file specified for redirection", file=sys.stderr)
-                    continue
-                cmd = cmd_parts[0]
-                args = cmd_parts[1:]
-                with open(outfile, "w") as f:
-                    if cmd in builtins:
-                        # Only echo and pwd produce output
-                        if cmd == "echo":
-                            print(" ".join(args), file=f)
-                        elif cmd == "pwd":
-                            print(shutil.os.getcwd(), file=f)
-                        else:
-                            # For other builtins, just run as normal (no output redirection needed)
-                            if cmd == "exit":
-                                status = 0
-                                if args:
-                                    try:
-                                        status = int(args[0])
-                                    except ValueError:
-                                        print(f"exit: {args[0]}: numeric argument required", file=sys.stderr)
-                                        status = 1
-                                sys.exit(status)
-                            elif cmd == "cd":
-                                if args:
-                                    target = args[0]
-                                    if target == "~":
-                                        target = os.environ.get("HOME", "")
-                                    try:
-                                        shutil.os.chdir(target)
-                                    except FileNotFoundError:
-                                        print(f"cd: {args[0]}: No such file or directory", file=sys.stderr)
-                                    except PermissionError:
-                                        print(f"cd: {args[0]}: Permission denied", file=sys.stderr)
-                                else:
-                                    print("cd: missing argument", file=sys.stderr)
-                            elif cmd == "type":
-                                if args:
-                                    try:
-                                        arg_cmd = str(args[0])
-                                        if arg_cmd in builtins:
-                                            out = f"{arg_cmd} is a shell builtin"
-                                        elif p := shutil.which(arg_cmd):
-                                            out = f"{arg_cmd} is {p}"
-                                        else:
-                                            out = f"{arg_cmd}: not found"
-                                    except Exception:
-                                        out = f"{args[0]}: unable to read argument to type command"
-                                else:
-                                    out = "argument required after type command"
-                                print(out, file=f)
-                    else:
-                        executable = shutil.which(cmd)
-                        if executable:
-                            try:
-                                subprocess.run([cmd] + args, stdout=f, stderr=sys.stderr)
-                            except Exception as e:
-                                print(f"Error executing {cmd}: {e}", file=sys.stderr)
-                        else:
-                            print(f"{cmd}: command not found", file=sys.stderr)
-                continue  # Skip normal command handling
-
-            # Output redirection support for errors
-            if "2>" in parts:
-                op_index = parts.index("2>")
-                cmd_parts = parts[:op_index]
-                errfile = parts[op_index + 1] if len(parts) > op_index + 1 else None
-                if not errfile:
-                    print("No error file specified for redirection", file=sys.stderr)
-                    continue
-                cmd = cmd_parts[0]
-                args = cmd_parts[1:]
-                with open(errfile, "w") as ef:
-                    if cmd in builtins:
-                        # Only echo and pwd produce output, errors go to ef
-                        if cmd == "echo":
-                            print(" ".join(args))
-                        elif cmd == "pwd":
-                            print(shutil.os.getcwd())
-                        else:
-                            if cmd == "exit":
-                                status = 0
-                                if args:
-                                    try:
-                                        status = int(args[0])
-                                    except ValueError:
-                                        print(f"exit: {args[0]}: numeric argument required", file=ef)
-                                        status = 1
-                                sys.exit(status)
-                            elif cmd == "cd":
-                                if args:
-                                    target = args[0]
-                                    if target == "~":
-                                        target = os.environ.get("HOME", "")
-                                    try:
-                                        shutil.os.chdir(target)
-                                    except FileNotFoundError:
-                                        print(f"cd: {args[0]}: No such file or directory", file=ef)
-                                    except PermissionError:
-                                        print(f"cd: {args[0]}: Permission denied", file=ef)
-                                else:
-                                    print("cd: missing argument", file=ef)
-                            elif cmd == "type":
-                                if args:
-                                    try:
-                                        arg_cmd = str(args[0])
-                                        if arg_cmd in builtins:
-                                            out = f"{arg_cmd} is a shell builtin"
-                                        elif p := shutil.which(arg_cmd):
-                                            out = f"{arg_cmd} is {p}"
-                                        else:
-                                            out = f"{arg_cmd}: not found"
-                                    except Exception:
-                                        out = f"{args[0]}: unable to read argument to type command"
-                                else:
-                                    out = "argument required after type command"
-                                print(out)
-                    else:
-                        executable = shutil.which(cmd)
-                        if executable:
-                            try:
-                                subprocess.run([cmd] + args, stdout=sys.stdout, stderr=ef)
-                            except Exception as e:
-                                print(f"Error executing {cmd}: {e}", file=ef)
-                        else:
-                            print(f"{cmd}: command not found", file=ef)
-                continue  # Skip normal command handling
-
-            # Output append support
-            if ">>" in parts or "1>>" in parts:
-                if ">>" in parts:
-                    op_index = parts.index(">>")
-                else:
-                    op_index = parts.index("1>>")
-                cmd_parts = parts[:op_index]
-                outfile = parts[op_index + 1] if len(parts) > op_index + 1 else None
-                if not outfile:
-                    print("No output file specified for append redirection", file=sys.stderr)
-                    continue
-                cmd = cmd_parts[0]
-                args = cmd_parts[1:]
-                with open(outfile, "a") as f:
-                    if cmd in builtins:
-                        if cmd == "echo":
-                            print(" ".join(args), file=f)
-                        elif cmd == "pwd":
-                            print(shutil.os.getcwd(), file=f)
-                        else:
-                            if cmd == "exit":
-                                status = 0
-                                if args:
-                                    try:
-                                        status = int(args[0])
-                                    except ValueError:
-                                        print(f"exit: {args[0]}: numeric argument required", file=sys.stderr)
-                                        status = 1
-                                sys.exit(status)
-                            elif cmd == "cd":
-                                if args:
-                                    target = args[0]
-                                    if target == "~":
-                                        target = os.environ.get("HOME", "")
-                                    try:
-                                        shutil.os.chdir(target)
-                                    except FileNotFoundError:
-                                        print(f"cd: {args[0]}: No such file or directory", file=sys.stderr)
-                                    except PermissionError:
-                                        print(f"cd: {args[0]}: Permission denied", file=sys.stderr)
-                                else:
-                                    print("cd: missing argument", file=sys.stderr)
-                            elif cmd == "type":
-                                if args:
-                                    try:
-                                        arg_cmd = str(args[0])
-                                        if arg_cmd in builtins:
-                                            out = f"{arg_cmd} is a shell builtin"
-                                        elif p := shutil.which(arg_cmd):
-                                            out = f"{arg_cmd} is {p}"
-                                        else:
-                                            out = f"{arg_cmd}: not found"
-                                    except Exception:
-                                        out = f"{args[0]}: unable to read argument to type command"
-                                else:
-                                    out = "argument required after type command"
-                                print(out, file=f)
-                    else:
-                        executable = shutil.which(cmd)
-                        if executable:
-                            try:
-                                subprocess.run([cmd] + args, stdout=f, stderr=sys.stderr)
-                            except Exception as e:
-                                print(f"Error executing {cmd}: {e}", file=sys.stderr)
-                        else:
-                            print(f"{cmd}: command not found", file=sys.stderr)
-                continue  # Skip normal command handling
-
-            # Append stderr support
-            if "2>>" in parts:
-                op_index = parts.index("2>>")
-                cmd_parts = parts[:op_index]
-                errfile = parts[op_index + 1] if len(parts) > op_index + 1 else None
-                if not errfile:
-                    print("No error file specified for append redirection", file=sys.stderr)
-                    continue
-                cmd = cmd_parts[0]
-                args = cmd_parts[1:]
-                with open(errfile, "a") as ef:
-                    if cmd in builtins:
-                        # Only echo and pwd produce output, errors go to ef
-                        if cmd == "echo":
-                            print(" ".join(args))
-                        elif cmd == "pwd":
-                            print(shutil.os.getcwd())
-                        else:
-                            if cmd == "exit":
-                                status = 0
-                                if args:
-                                    try:
-                                        status = int(args[0])
-                                    except ValueError:
-                                        print(f"exit: {args[0]}: numeric argument required", file=ef)
-                                        status = 1
-                                sys.exit(status)
-                            elif cmd == "cd":
-                                if args:
-                                    target = args[0]
-                                    if target == "~":
-                                        target = os.environ.get("HOME", "")
-                                    try:
-                                        shutil.os.chdir(target)
-                                    except FileNotFoundError:
-                                        print(f"cd: {args[0]}: No such file or directory", file=ef)
-                                    except PermissionError:
-                                        print(f"cd: {args[0]}: Permission denied", file=ef)
-                                else:
-                                    print("cd: missing argument", file=ef)
-                            elif cmd == "type":
-                                if args:
-                                    try:
-                                        arg_cmd = str(args[0])
-                                        if arg_cmd in builtins:
-                                            out = f"{arg_cmd} is a shell builtin"
-                                        elif p := shutil.which(arg_cmd):
-                                            out = f"{arg_cmd} is {p}"
-                                        else:
-                                            out = f"{arg_cmd}: not found"
-                                    except Exception:
-                                        out = f"{args[0]}: unable to read argument to type command"
-                                else:
-                                    out = "argument required after type command"
-                                print(out)
-                    else:
-                        executable = shutil.which(cmd)
-                        if executable:
-                            try:
-                                subprocess.run([cmd] + args, stdout=sys.stdout, stderr=ef)
-                            except Exception as e:
-                                print(f"Error executing {cmd}: {e}", file=ef)
-                        else:
-                            print(f"{cmd}: command not found", file=ef)
-                continue  # Skip normal command handling
-
-            cmd = parts[0]
-            args = parts[1:]
-
-            if cmd == "type":
-                if args:
-                    try:
-                        arg_cmd = str(args[0])
-                        if arg_cmd in builtins:
-                            out = f"{arg_cmd} is a shell builtin"
-                        elif p := shutil.which(arg_cmd):
-                            out = f"{arg_cmd} is {p}"
-                        else:
-                            out = f"{arg_cmd}: not found"
-                    except Exception:
-                        out = f"{args[0]}: unable to read argument to type command"
-                else:
-                    out = "argument required after type command"
-                print(out)
+    Like bash, the redirection files are still created; if one of them is
+    what failed, that is the error reported instead and True is returned.
+    """
+    try:
+        table, opened = open_redirects(redirects)
+    except OSError as e:
+        print(f"{e.filename}: {e.strerror}", file=sys.stderr)
+        return True
+    try:
+        os.write(table[2], (message + "\n").encode())
+    finally:
+        close_fds(opened)
+    return False
 
-            elif cmd == "echo":
-                if args:
-                    print(" ".join(args))
-                else:
-                    print("")
-
-            elif cmd == "exit":
-                status = 0  # Default exit code
-                if args:
-                    try:
-                        status = int(args[0])
-                    except ValueError:
-                        print(f"exit: {args[0]}: numeric argument required", file=sys.stderr)
-                        status = 1
-                sys.exit(status)
-
-            elif cmd == "pwd":
-                print(shutil.os.getcwd())
-            
-            elif cmd == "cd":
-                if args:
-                    target = args[0]
-                    if target == "~":
-                        target = os.environ.get("HOME", "")
-                    try:
-                        shutil.os.chdir(target)
-                    except FileNotFoundError:
-                        print(f"cd: {args[0]}: No such file or directory", file=sys.stderr)
-                    except PermissionError:
-                        print(f"cd: {args[0]}: Permission denied", file=sys.stderr)
-                else:
-                    print("cd: missing argument", file=sys.stderr)
+def new_stage_stats(command, measured=True):
+    """Expand a command and start its measurements, filled in as it runs.
 
-            else:
-                # Check if command exists in PATH
-                executable = shutil.which(cmd)
-                if executable:
-                    try:
-                        # Run the external program with arguments
-                        subprocess.run([cmd] + args)
-                    except Exception as e:
-                        print(f"Error executing {cmd}: {e}")
-                else:
-                    print(f"{cmd}: command not found")
-                    
-        except EOFError:
-            break
+    They feed the time keyword and the PYSH_TRACE records; when neither
+    wants them (measured false), builtins skip their getrusage calls. The
+    status starts out as that of the last $(...) in the expansions, which
+    is what a command of nothing but assignments returns.
+    """
+    shell_state["subst_status"] = None
+    if isinstance(command, Command):
+        argv = expand_words(command.argv)
+        redirects = assigns = ()
+        if command.redirects:
+            redirects = tuple((fd, expand_value(target), flags) for fd, target, flags in command.redirects)
+        if command.assigns:
+            assigns = [(name, expand_value(value)) for name, value in command.assigns]
+    else:
+        # A compound command expands its words as it runs them
+        argv, redirects, assigns = [compound_name(command)], (), []
+    stats = {
+        "argv": argv,
+        "redirects": redirects,
+        "assigns": assigns,
+        "kind": "none",
+        "measured": measured,
+        "start": time.perf_counter(),
+        "end": None,
+        "lookup_s": 0.0,
+        "spawn_s": 0.0,
+        "user_s": 0.0,
+        "sys_s": 0.0,
+        "maxrss_kb": 0,
+        "bytes_out": None,
+        "status": 0,
+    }
+    stats["status"] = shell_state["subst_status"] or 0
+    return stats
+
+def thread_usage(stats):
+    """This thread's CPU usage so far, or None if the stage is not measured."""
+    return resource.getrusage(RUSAGE_THREAD) if stats["measured"] else None
+
+def record_thread_usage(stats, before):
+    """Charge the CPU time this thread used since before to a builtin stage."""
+    stats["end"] = time.perf_counter()
+    if before is None:
+        return
+    after = resource.getrusage(RUSAGE_THREAD)
+    stats["user_s"] = after.ru_utime - before.ru_utime
+    stats["sys_s"] = after.ru_stime - before.ru_stime
+    stats["maxrss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def start_external(cmd, args, redirects, stats, stdin=None, stdout=None):
+    """Look up and launch an external command; None if it could not start."""
+    stats["kind"] = "external"
+    started = time.perf_counter()
+    executable = find_executable(cmd)
+    looked_up = time.perf_counter()
+    stats["lookup_s"] = looked_up - started
+    if not executable:
+        redirect_failed = report_launch_error(f"{cmd}: command not found", redirects)
+        stats["status"] = 1 if redirect_failed else 127
+        return None
+    # name=value words before the command go into its environment only
+    env = dict(os.environ, **dict(stats["assigns"])) if stats["assigns"] else None
+    try:
+        proc = launch([cmd] + args, executable, stdin=stdin, stdout=stdout, redirects=redirects, env=env)
+    except OSError as e:
+        # A redirection that cannot be opened fails the command with 1, as
+        # in sh; 126 is for a command that cannot be executed
+        redirect_failed = report_launch_error(f"Error executing {cmd}: {e}", redirects)
+        stats["status"] = 1 if redirect_failed else 126
+        return None
+    stats["spawn_s"] = time.perf_counter() - looked_up
+    return proc
+
+def finish_external(proc, stats):
+    proc.wait()
+    stats["end"] = time.perf_counter()
+    stats["status"] = exit_status(proc.returncode)
+    if proc.rusage is not None:
+        stats["user_s"] = proc.rusage.ru_utime
+        stats["sys_s"] = proc.rusage.ru_stime
+        stats["maxrss_kb"] = proc.rusage.ru_maxrss
+
+def drain_fd(fd, writer):
+    """Copy fd to EOF into writer."""
+    while chunk := os.read(fd, IO_CHUNK):
+        writer.write(chunk)
+
+def run_external(cmd, args, redirects, stats, capture=None):
+    """Run an external command in the foreground and return its exit status.
+
+    With capture, its stdout is read through a pipe into that BufferWriter.
+    """
+    if capture is None:
+        proc = start_external(cmd, args, redirects, stats)
+    else:
+        read_fd, write_fd = os.pipe()
+        try:
+            proc = start_external(cmd, args, redirects, stats, stdout=write_fd)
+        finally:
+            os.close(write_fd)
+        try:
+            drain_fd(read_fd, capture)
+        finally:
+            os.close(read_fd)
+    if proc is not None:
+        finish_external(proc, stats)
+    return stats["status"]
+
+# Stands for a capture buffer in a builtin's fd table
+CAPTURE_FD = -1
+
+class BuiltinStreams:
+    """A builtin's view of its redirected fds: an input fd and output channels.
+
+    stdin_fd and stdout_fd are the pipe ends a pipeline stage starts with
+    (the caller still owns them); capture is a BufferWriter standing in for
+    stdout, as for $(...). When stdout and stderr end up on the same fd, as
+    after 2>&1, both are one writer so their output keeps its order.
+    """
+    __slots__ = ("inp", "out", "err", "opened")
+
+    def __init__(self, redirects, stdin_fd=None, stdout_fd=None, capture=None):
+        if capture is not None:
+            stdout_fd = CAPTURE_FD
+        fds = {0: 0 if stdin_fd is None else stdin_fd,
+               1: sys.stdout.fileno() if stdout_fd is None else stdout_fd,
+               2: sys.stderr.fileno()}
+        table, self.opened = open_redirects(redirects, fds)
+        self.inp = table[0]
+        self.out = capture if table[1] == CAPTURE_FD else FdWriter(table[1])
+        if table[2] == table[1]:
+            self.err = self.out
+        else:
+            self.err = capture if table[2] == CAPTURE_FD else FdWriter(table[2])
+
+    def close(self):
+        """Flush both channels and close the files the redirections opened."""
+        try:
+            self.out.close()
+        finally:
+            try:
+                if self.err is not self.out:
+                    self.err.close()
+            finally:
+                close_fds(self.opened)
+
+def run_builtin_stage(command, stdin_fd, stdout_fd, stats):
+    """Run one builtin pipeline stage; owns and closes its pipe ends."""
+    before = thread_usage(stats)
+    cmd = stats["argv"][0]
+    streams = None
+    try:
+        streams = BuiltinStreams(stats["redirects"], stdin_fd, stdout_fd)
+    except OSError as e:
+        print(f"{e.filename}: {e.strerror}", file=sys.stderr)
+        stats["status"] = 1
+    try:
+        if streams is not None:
+            try:
+                stats["status"] = run_builtin(cmd, stats["argv"][1:],
+                                              inp=streams.inp, out=streams.out, err=streams.err)
+            finally:
+                streams.close()
+    except BrokenPipeError:
+        # The reader went away; report it the way a SIGPIPE'd process would
+        stats["status"] = 128 + signal.SIGPIPE
+    except SystemExit as e:
+        # Pipeline stages run in a subshell in bash, so exit only ends the stage
+        stats["status"] = e.code if isinstance(e.code, int) else 1
+    except ControlFlow as e:
+        # and so do break, continue and return
+        stats["status"] = e.count if e.kind == "return" else 0
+    except OSError as e:
+        print(f"{cmd}: write error: {e.strerror}", file=sys.stderr)
+        stats["status"] = 1
+    finally:
+        if streams is not None:
+            stats["bytes_out"] = streams.out.bytes_written
+        for fd in (stdin_fd, stdout_fd):
+            if fd is not None:
+                os.close(fd)
+        record_thread_usage(stats, before)
+
+def relay_stage_output(src_fd, dst_fd, stats):
+    """Copy an external stage's output on to the next stage, counting it.
+
+    Only used while tracing, so bytes_out is known for every stage.
+    """
+    try:
+        stats["bytes_out"] = copy_fd(src_fd, dst_fd)
+    except BrokenPipeError as e:
+        stats["bytes_out"] = e.copied
+    finally:
+        os.close(src_fd)
+        os.close(dst_fd)
+
+def run_redirects_only(redirects):
+    """A command with no words still creates its redirection files."""
+    try:
+        close_fds(open_redirects(redirects)[1])
+    except OSError as e:
+        print(f"{e.filename}: {e.strerror}", file=sys.stderr)
+        return 1
+    return 0
+
+def run_command(command, stats, capture=None):
+    """Run a single simple command in the foreground and return its status.
+
+    A command of only assignments sets those variables in the shell.
+    """
+    if not stats["argv"]:
+        for name, value in stats["assigns"]:
+            set_variable(name, value)
+        if stats["redirects"] and run_redirects_only(stats["redirects"]) != 0:
+            stats["status"] = 1
+        stats["end"] = time.perf_counter()
+        return stats["status"]
+    cmd, args = stats["argv"][0], stats["argv"][1:]
+    if cmd in shell_functions:
+        return run_function(cmd, args, stats, capture)
+    if cmd not in builtins:
+        return run_external(cmd, args, stats["redirects"], stats, capture)
+    stats["kind"] = "builtin"
+    before = thread_usage(stats)
+    try:
+        streams = BuiltinStreams(stats["redirects"], capture=capture)
+    except OSError as e:
+        print(f"{e.filename}: {e.strerror}", file=sys.stderr)
+        stats["status"] = 1
+        record_thread_usage(stats, before)
+        return 1
+    try:
+        try:
+            stats["status"] = run_builtin(cmd, args, inp=streams.inp, out=streams.out, err=streams.err)
+        finally:
+            streams.close()
+    except BrokenPipeError:
+        # The reader went away; report it the way a SIGPIPE'd process would.
+        # Only an interactive shell survives that, as sh would.
+        stats["status"] = 128 + signal.SIGPIPE
+        if not shell_state["interactive"]:
+            sys.exit(stats["status"])
+    except OSError as e:
+        print(f"{cmd}: write error: {e.strerror}", file=sys.stderr)
+        stats["status"] = 1
+    finally:
+        stats["bytes_out"] = streams.out.bytes_written
+        record_thread_usage(stats, before)
+    return stats["status"]
+
+# How deeply functions may call each other, like bash's FUNCNEST
+FUNCTION_NEST_MAX = 1000
+
+def compound_name(command):
+    """What a compound command is called in time output and the trace."""
+    if isinstance(command, FunctionDef):
+        return command.name
+    if isinstance(command, While):
+        return "until" if command.until else "while"
+    if isinstance(command, Group):
+        return "(" if command.subshell else "{"
+    return "if" if isinstance(command, If) else "for"
+
+def redirect_shell_fds(redirects):
+    """Point the shell's own fds at a compound command's redirections.
+
+    Everything the command runs, builtins and children alike, then uses
+    them. Returns {fd: saved copy, or None if it was closed}, for
+    restore_shell_fds. The originals are all saved before any is replaced,
+    so 2>&1 >file duplicates the old stdout as it should.
+    """
+    if not redirects:
+        return {}
+    table, opened = open_redirects(redirects)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = {}
+    try:
+        for fd, source in table.items():
+            if source != fd:
+                try:
+                    saved[fd] = os.dup(fd)
+                except OSError:
+                    saved[fd] = None
+        for fd in saved:
+            copy = saved.get(source := table[fd])
+            os.dup2(source if copy is None else copy, fd)
+    except OSError:
+        restore_shell_fds(saved)
+        raise
+    finally:
+        close_fds(opened)
+    return saved
+
+def restore_shell_fds(saved):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    for fd, copy in saved.items():
+        if copy is None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        else:
+            os.dup2(copy, fd)
+            os.close(copy)
+
+def run_compound_stage(command, stats, capture=None):
+    """Run a compound command that is a whole pipeline, in the shell itself."""
+    stats["kind"] = "compound"
+    before = thread_usage(stats)
+    try:
+        stats["status"] = run_compound(command, capture)
+    finally:
+        record_thread_usage(stats, before)
+
+def run_compound(command, capture=None):
+    """Run a compound command in the shell and return its status.
+
+    Its redirections are applied to the shell's fds for as long as it runs;
+    once stdout is redirected, capture no longer applies.
+    """
+    if isinstance(command, FunctionDef):
+        shell_functions[command.name] = command.body
+        return 0
+    try:
+        saved = redirect_shell_fds(tuple((fd, expand_value(target), flags)
+                                         for fd, target, flags in command.redirects))
+    except OSError as e:
+        print(f"{e.filename}: {e.strerror}", file=sys.stderr)
+        return 1
+    if 1 in saved:
+        capture = None
+    try:
+        if isinstance(command, If):
+            for condition, body in command.clauses:
+                if run_condition(condition, capture) == 0:
+                    return run_list(body, capture)
+            return 0 if command.else_body is None else run_list(command.else_body, capture)
+        if isinstance(command, Group):
+            if command.subshell:
+                return run_subshell(command.body, capture)
+            return run_list(command.body, capture)
+        return run_loop(command, capture)
+    finally:
+        restore_shell_fds(saved)
+
+def end_of_iteration(e):
+    """Whether a break or continue stops at the innermost running loop.
+
+    One that names more levels is passed on to the enclosing loop with a
+    level fewer, and a return always is.
+    """
+    if e.kind == "return":
+        return False
+    if e.count > 1:
+        e.count -= 1
+        return False
+    return True
+
+def run_loop(command, capture=None):
+    """Run a while, until or for loop and return the status of its body's
+    last command (0 if the body never ran).
+
+    The body is the same parsed tree on every iteration. The outermost
+    running loop also pins the command paths it resolves, so only the first
+    iteration looks anything up, unless PATH changes.
+    """
+    shell_state["loop_depth"] += 1
+    outermost = command_hash["pinned"] is None
+    if outermost:
+        command_hash["pinned"] = {}
+    status = 0
+    try:
+        if isinstance(command, For):
+            words = shell_state["positional"] if command.words is None else expand_words(command.words)
+            for word in list(words):
+                set_variable(command.name, word)
+                try:
+                    status = run_list(command.body, capture)
+                except ControlFlow as e:
+                    if not end_of_iteration(e):
+                        raise
+                    status = 0
+                    if e.kind == "break":
+                        break
+        else:
+            while True:
+                try:
+                    if (run_condition(command.condition, capture) == 0) == command.until:
+                        break
+                    status = run_list(command.body, capture)
+                except ControlFlow as e:
+                    if not end_of_iteration(e):
+                        raise
+                    status = 0
+                    if e.kind == "break":
+                        break
+    finally:
+        shell_state["loop_depth"] -= 1
+        if outermost:
+            command_hash["pinned"] = None
+    return status
+
+def run_function(name, args, stats, capture=None):
+    """Call a shell function in the shell itself and return its status.
+
+    The arguments are $1.. for the duration of the call, and so are the
+    command's redirections and its name=value prefixes, which are exported
+    to what the function runs and then put back like locals.
+    """
+    stats["kind"] = "function"
+    if len(shell_state["locals"]) >= FUNCTION_NEST_MAX:
+        print(f"{name}: maximum function nesting level exceeded ({FUNCTION_NEST_MAX})", file=sys.stderr)
+        stats["status"] = 1
+        return 1
+    try:
+        saved = redirect_shell_fds(stats["redirects"])
+    except OSError as e:
+        print(f"{e.filename}: {e.strerror}", file=sys.stderr)
+        stats["status"] = 1
+        return 1
+    frame = {}
+    positional = shell_state["positional"]
+    shell_state["locals"].append(frame)
+    shell_state["positional"] = args
+    try:
+        for var, value in stats["assigns"]:
+            frame.setdefault(var, (shell_vars.get(var), os.environ.get(var)))
+            shell_vars.pop(var, None)
+            os.environ[var] = value
+        stats["status"] = run_compound(shell_functions[name], None if 1 in saved else capture)
+    except ControlFlow as e:
+        if e.kind != "return":
+            raise
+        stats["status"] = e.count
+    except RecursionError:
+        # Bodies of nested compound commands take more Python frames per
+        # call, so they can run out of stack before FUNCTION_NEST_MAX
+        print(f"{name}: maximum function nesting level exceeded ({len(shell_state['locals'])})",
+              file=sys.stderr)
+        stats["status"] = 1
+    finally:
+        shell_state["positional"] = positional
+        restore_locals(shell_state["locals"].pop())
+        restore_shell_fds(saved)
+        stats["end"] = time.perf_counter()
+    return stats["status"]
+
+def wait_for_stages(procs, stages):
+    """Reap pipeline children in the order they exit.
+
+    pidfds tell us which child finished first, so each stage's end time is
+    its own; without them the children are reaped in pipeline order.
+    """
+    pidfds = {}
+    try:
+        for i, proc in procs:
+            pidfds[os.pidfd_open(proc.pid)] = (i, proc)
+    except (AttributeError, OSError):
+        for fd in pidfds:
+            os.close(fd)
+        for i, proc in procs:
+            finish_external(proc, stages[i])
+        return
+    while pidfds:
+        ready, _, _ = select.select(list(pidfds), [], [])
+        for fd in ready:
+            i, proc = pidfds.pop(fd)
+            os.close(fd)
+            finish_external(proc, stages[i])
+
+def run_stages(commands, stages, tracing, capture=None):
+    """Start every stage of a pipeline at once, joined by OS pipes.
+
+    Externals read and write the pipe fds directly; builtins run on threads
+    that write into them. Data never passes through the shell, so memory
+    stays bounded by the pipe buffers and a consumer that exits early
+    delivers SIGPIPE upstream. With capture, the last stage writes to one
+    more pipe, which the shell reads into that BufferWriter. Compound
+    commands, function calls and builtins that change the shell's state run
+    in forked subshells, as in bash, so that cd or export in a pipeline
+    leaves the shell itself alone.
+    """
+    n = len(commands)
+    procs = []
+    threads = []
+    pipe_fds = []  # Every pipe fd opened here, for forked stages to close
+    ends = []  # Each stage's (stdin, stdout) pipe ends, None for the shell's own
+    prev_read = None  # Read end of the previous stage's output pipe
+    sys.stdout.flush()
+    for i in range(n):
+        if i < n - 1 or capture is not None:
+            read_fd, write_fd = os.pipe()
+            pipe_fds += (read_fd, write_fd)
+        else:
+            read_fd, write_fd = None, None
+        ends.append((prev_read, write_fd))
+        prev_read = read_fd
+
+    def close_ends(stdin_fd, write_fd):
+        # The child holds its own copies; closing ours lets EOF and SIGPIPE
+        # propagate once the neighbouring stages exit
+        for fd in (stdin_fd, write_fd):
+            if fd is not None:
+                os.close(fd)
+
+    # Subshell stages are forked before any stage thread starts: forking a
+    # process that has other threads running can deadlock the child
+    forked = set()
+    for i, command in enumerate(commands):
+        stats = stages[i]
+        if not isinstance(command, Command) or stats["argv"] and (stats["argv"][0] in shell_functions
+                                                                 or stats["argv"][0] in state_builtins):
+            procs.append((i, start_subshell_stage(command, stats, *ends[i], pipe_fds)))
+            close_ends(*ends[i])
+            forked.add(i)
+
+    for i, command in enumerate(commands):
+        if i in forked:
+            continue
+        stats = stages[i]
+        stdin_fd, write_fd = ends[i]
+        if not stats["argv"]:
+            stats["status"] = run_redirects_only(stats["redirects"])
+        else:
+            cmd, args = stats["argv"][0], stats["argv"][1:]
+            if cmd in builtins or use_native_util(cmd, args):
+                stats["kind"] = "builtin" if cmd in builtins else "native"
+                t = threading.Thread(target=run_builtin_stage, args=(command, stdin_fd, write_fd, stats))
+                t.start()
+                threads.append(t)
+                continue
+
+            stage_out = write_fd
+            if tracing and write_fd is not None:
+                # Interpose a counting relay between this stage and the next
+                relay_read, stage_out = os.pipe()
+                t = threading.Thread(target=relay_stage_output, args=(relay_read, write_fd, stats))
+                t.start()
+                threads.append(t)
+                write_fd = stage_out
+            proc = start_external(cmd, args, stats["redirects"], stats, stdin=stdin_fd, stdout=stage_out)
+            if proc is not None:
+                procs.append((i, proc))
+        close_ends(stdin_fd, write_fd)
+
+    if capture is not None:
+        try:
+            drain_fd(prev_read, capture)
+        finally:
+            os.close(prev_read)
+    wait_for_stages(procs, stages)
+    for t in threads:
+        t.join()
+
+def run_pipeline(pipeline, capture=None):
+    """Run a pipeline and return its status.
+
+    Each stage's exit status is collected in shell_state["pipestatus"], which
+    $PIPESTATUS reads.
+    Timed pipelines report their resource usage and, with PYSH_TRACE set,
+    every command is written to the trace as a JSON line.
+    """
+    start = time.perf_counter()
+    tracing = trace_fd() is not None
+    stages = [new_stage_stats(command, tracing or pipeline.timed) for command in pipeline.commands]
+    if len(stages) > 1:
+        run_stages(pipeline.commands, stages, tracing, capture)
+    elif isinstance(pipeline.commands[0], Command):
+        run_command(pipeline.commands[0], stages[0], capture)
+    else:
+        run_compound_stage(pipeline.commands[0], stages[0], capture)
+    statuses = [stats["status"] for stats in stages]
+    status = statuses[-1]
+    if pipeline.negated:
+        status = int(status == 0)
+    shell_state["pipestatus"] = statuses
+    shell_state["last_status"] = status
+    if pipeline.timed:
+        report_times(stages, start)
+    if tracing:
+        write_trace(stages)
+    return status
+
+def format_seconds(seconds):
+    return f"{int(seconds // 60)}m{seconds % 60:.3f}s"
+
+def report_times(stages, start):
+    """Print bash-style time output, with a line per stage for pipelines."""
+    lines = [
+        "",
+        f"real\t{format_seconds(time.perf_counter() - start)}",
+        f"user\t{format_seconds(sum(s['user_s'] for s in stages))}",
+        f"sys\t{format_seconds(sum(s['sys_s'] for s in stages))}",
+        f"maxrss\t{max(s['maxrss_kb'] for s in stages)}k",
+    ]
+    if len(stages) > 1:
+        for i, s in enumerate(stages, 1):
+            real = (s["end"] or s["start"]) - s["start"]
+            lines.append(f"[{i}] real {format_seconds(real)} user {format_seconds(s['user_s'])} "
+                         f"sys {format_seconds(s['sys_s'])} maxrss {s['maxrss_kb']}k "
+                         f"status {s['status']}\t{' '.join(s['argv'])}")
+    print("\n".join(lines), file=sys.stderr)
+
+# Append-only fd for the PYSH_TRACE file, reopened when the variable changes
+trace_state = {"path": None, "fd": None}
+
+def trace_fd():
+    path = os.environ.get("PYSH_TRACE") or None
+    if path != trace_state["path"]:
+        if trace_state["fd"] is not None:
+            os.close(trace_state["fd"])
+        trace_state["path"] = path
+        trace_state["fd"] = None
+        if path:
+            try:
+                trace_state["fd"] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+            except OSError as e:
+                print(f"PYSH_TRACE: {path}: {e.strerror}", file=sys.stderr)
+    return trace_state["fd"]
+
+def write_trace(stages):
+    """Append one JSON record per command; a single write keeps concurrent
+    shells from interleaving their records.
+
+    Besides each command's own usage, records carry the shell's peak RSS
+    and how much its BufferWriters have spilled to disk so far.
+    """
+    import json
+    shell_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    records = []
+    for i, s in enumerate(stages):
+        records.append(json.dumps({
+            "time": time.time(),
+            "pid": os.getpid(),
+            "argv": s["argv"],
+            "kind": s["kind"],
+            "redirects": [[fd, target, REDIRECT_MODES[flags]] for fd, target, flags in s["redirects"]],
+            "stage": i,
+            "stages": len(stages),
+            "parse_us": shell_state["parse_s"] * 1e6,
+            "lookup_us": s["lookup_s"] * 1e6,
+            "spawn_us": s["spawn_s"] * 1e6,
+            "run_us": ((s["end"] or s["start"]) - s["start"]) * 1e6,
+            "bytes_out": s["bytes_out"],
+            "status": s["status"],
+            "user_s": s["user_s"],
+            "sys_s": s["sys_s"],
+            "maxrss_kb": s["maxrss_kb"],
+            "shell_maxrss_kb": shell_maxrss,
+            "spill_files": spill_stats["files"],
+            "spilled_bytes": spill_stats["bytes"],
+        }) + "\n")
+    os.write(trace_state["fd"], "".join(records).encode())
+
+def run_exempt(run, *args):
+    """Call run(*args) with errexit suspended, as for conditions, && and ||
+    operands other than the last, and ! pipelines."""
+    shell_state["errexit_ignored"] += 1
+    try:
+        return run(*args)
+    finally:
+        shell_state["errexit_ignored"] -= 1
+
+def run_condition(condition, capture=None):
+    return run_exempt(run_list, condition, capture)
+
+def run_and_or(and_or, capture=None):
+    """Run pipelines joined by && and ||, returning the last status and
+    whether errexit applies to it: only the final pipeline can trigger it."""
+    status = 0
+    checked = False
+    last = len(and_or.items) - 1
+    for i, (connector, pipeline) in enumerate(and_or.items):
+        if connector == "&&" and status != 0 or connector == "||" and status == 0:
+            continue
+        checked = i == last and not pipeline.negated
+        if checked:
+            status = run_pipeline(pipeline, capture)
+        else:
+            status = run_exempt(run_pipeline, pipeline, capture)
+    return status, checked
+
+def run_list(command_list, capture=None):
+    """Run a parsed line, starting the parts that end in & as jobs.
+
+    capture is a BufferWriter that collects the line's stdout instead of
+    fd 1, for $(...). With errexit set (-e), a failing and-or list exits the
+    shell unless it runs somewhere errexit is suspended.
+    """
+    status = shell_state["last_status"]
+    for and_or, background in command_list.items:
+        if background:
+            start_job(and_or)
+            status = shell_state["last_status"] = 0
+            continue
+        status, checked = run_and_or(and_or, capture)
+        if (status != 0 and checked and shell_state["errexit"]
+                and not shell_state["errexit_ignored"]):
+            sys.exit(status)
+    return status
+
+def needs_subshell(command_list):
+    """Whether running a command list in-process could change the shell:
+    background jobs, assignments, state-changing builtins, function calls
+    and definitions, for loops (which assign their variable), or a command
+    name that is only known after expansion."""
+    for and_or, background in command_list.items:
+        if background:
+            return True
+        for _, pipeline in and_or.items:
+            for command in pipeline.commands:
+                if changes_shell(command):
+                    return True
+    return False
+
+def changes_shell(command):
+    if isinstance(command, Command):
+        if command.assigns:
+            return True
+        name = command.argv[0] if command.argv else None
+        return name is not None and (not isinstance(name, str) or name in state_builtins or name in shell_functions)
+    if isinstance(command, (For, FunctionDef)):
+        return True
+    if isinstance(command, Group) and command.subshell:
+        return False
+    return any(needs_subshell(part) for part in compound_lists(command))
+
+def compound_lists(command):
+    """The command lists a compound command is made of."""
+    if isinstance(command, If):
+        lists = [part for clause in command.clauses for part in clause]
+        return lists if command.else_body is None else lists + [command.else_body]
+    if isinstance(command, While):
+        return [command.condition, command.body]
+    if isinstance(command, FunctionDef):
+        return compound_lists(command.body)
+    return [command.body]
+
+def fork_subshell(run):
+    """Fork a subshell that exits with the status run() returns; the parent
+    gets the child's pid.
+
+    The shell must have no other threads when it forks, or the child can
+    deadlock on a lock one of them held, so a directory listing started for
+    completion is waited for first.
+    """
+    for thread in list(completion_scans.values()):
+        thread.join()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 1
+    try:
+        job_table.clear()
+        shell_state["interactive"] = False
+        status = run()
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except ControlFlow as e:
+        status = e.count if e.kind == "return" else 0
+    except BrokenPipeError:
+        status = 128 + signal.SIGPIPE
+    finally:
+        try:
+            sys.stdout.flush()
+        except OSError:
+            pass
+        os._exit(status)
+
+def run_subshell(command_list, capture=None):
+    """Run a command list in a forked child, reading its stdout into capture
+    when there is one."""
+    if capture is None:
+        pid = fork_subshell(lambda: run_list(command_list))
+    else:
+        read_fd, write_fd = os.pipe()
+
+        def run():
+            os.close(read_fd)
+            os.dup2(write_fd, 1)
+            os.close(write_fd)
+            return run_list(command_list)
+
+        pid = fork_subshell(run)
+        os.close(write_fd)
+        try:
+            drain_fd(read_fd, capture)
+        finally:
+            os.close(read_fd)
+    _, status = os.waitpid(pid, 0)
+    return exit_status(os.waitstatus_to_exitcode(status))
+
+def start_subshell_stage(command, stats, stdin_fd, stdout_fd, pipe_fds):
+    """Fork the subshell for a compound command or function call in a
+    pipeline, with stdin_fd and stdout_fd as its fds 0 and 1.
+
+    A forked child inherits every fd, so it closes all of the pipeline's
+    pipe fds (pipe_fds) after installing its own; otherwise it could hold
+    open the write end of the very pipe it reads and never see EOF.
+    """
+    stats["kind"] = "subshell"
+
+    def run():
+        for fd, target in ((stdin_fd, 0), (stdout_fd, 1)):
+            if fd is not None:
+                os.dup2(fd, target)
+        for fd in pipe_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if isinstance(command, Command):
+            return run_command(command, stats)
+        return run_compound(command)
+
+    return SpawnedProcess(fork_subshell(run))
+
+def command_substitution(source):
+    """Run the source of a $(...) and return its output minus trailing newlines.
+
+    Builtins, natives and externals run in-process, the same way as at the
+    prompt, with stdout captured into a buffer (through a pipe for
+    externals). Only lists that could change the shell fork a subshell.
+    """
+    command_list = parse(source)
+    capture = BufferWriter()
+    # As in bash, errexit does not carry into command substitutions
+    if needs_subshell(command_list):
+        status = run_exempt(run_subshell, command_list, capture)
+    else:
+        status = run_exempt(run_list, command_list, capture)
+    # Later expansions in the same command see it as $?, as in bash
+    shell_state["subst_status"] = shell_state["last_status"] = status
+    try:
+        with capture.view() as view:
+            return str(view, "utf-8", "surrogateescape").rstrip("\n")
+    finally:
+        capture.release()
+
+def format_command(command):
+    if isinstance(command, Command):
+        words = [f"{name}={value}" for name, value in command.assigns] + [str(word) for word in command.argv]
+    else:
+        words = [format_compound(command)]
+    for fd, target, flags in command.redirects:
+        op = {REDIRECT_APPEND: ">>", REDIRECT_READ: "<", REDIRECT_DUP: "<&" if fd == 0 else ">&"}.get(flags, ">")
+        prefix = "" if fd == (0 if op[0] == "<" else 1) else str(fd)
+        words.append(f"{prefix}{op}{target}" if flags is REDIRECT_DUP else f"{prefix}{op} {target}")
+    return " ".join(words)
+
+def format_compound(command):
+    if isinstance(command, If):
+        parts = [f"{'if' if i == 0 else 'elif'} {format_list(condition)}; then {format_list(body)};"
+                 for i, (condition, body) in enumerate(command.clauses)]
+        if command.else_body is not None:
+            parts.append(f"else {format_list(command.else_body)};")
+        return " ".join(parts) + " fi"
+    if isinstance(command, While):
+        return f"{compound_name(command)} {format_list(command.condition)}; do {format_list(command.body)}; done"
+    if isinstance(command, For):
+        words = "" if command.words is None else " in " + " ".join(str(word) for word in command.words)
+        return f"for {command.name}{words}; do {format_list(command.body)}; done"
+    if isinstance(command, Group):
+        if command.subshell:
+            return f"( {format_list(command.body)} )"
+        return f"{{ {format_list(command.body)}; }}"
+    return f"{command.name} () {format_compound(command.body)}"
+
+def format_list(command_list):
+    text = ""
+    for and_or, background in command_list.items:
+        if text:
+            text += " " if text.endswith("&") else "; "
+        text += format_and_or(and_or) + (" &" if background else "")
+    return text
+
+def format_and_or(and_or):
+    parts = []
+    for connector, pipeline in and_or.items:
+        if connector:
+            parts.append(connector)
+        parts.append(("! " if pipeline.negated else "") + " | ".join(format_command(c) for c in pipeline.commands))
+    return " ".join(parts)
+
+class Job:
+    """A background job: a forked subshell leading its own process group."""
+    __slots__ = ("id", "pid", "command", "state", "returncode")
+
+    def __init__(self, id, pid, command):
+        self.id = id
+        self.pid = pid
+        self.command = command
+        self.state = "Running"
+        self.returncode = None
+
+    def update(self, status):
+        """Record a status reported by waitpid."""
+        if os.WIFSTOPPED(status):
+            self.state = "Stopped"
+        elif os.WIFCONTINUED(status):
+            self.state = "Running"
+        else:
+            self.returncode = os.waitstatus_to_exitcode(status)
+            if self.returncode == 0:
+                self.state = "Done"
+            elif self.returncode > 0:
+                self.state = f"Exit {self.returncode}"
+            else:
+                self.state = signal.strsignal(-self.returncode) or f"Signal {-self.returncode}"
+
+# Background jobs by job number
+job_table = {}
+
+def reap_jobs(signum=None, frame=None):
+    """SIGCHLD handler: collect status changes of background jobs.
+
+    Only job pids are waited for, so foreground children are left for the
+    code that launched them.
+    """
+    for job in list(job_table.values()):
+        if job.returncode is not None:
+            continue
+        try:
+            pid, status = os.waitpid(job.pid, os.WNOHANG | os.WUNTRACED | os.WCONTINUED)
+        except ChildProcessError:
+            continue
+        if pid:
+            job.update(status)
+
+def start_job(and_or):
+    """Run an and-or list in the background in a forked subshell."""
+
+    def run():
+        os.setpgid(0, 0)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        status, _ = run_and_or(and_or)
+        return status
+
+    pid = fork_subshell(run)
+    # Set the group from both sides so it exists before either one proceeds
+    try:
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    job = Job(max(job_table, default=0) + 1, pid, format_and_or(and_or))
+    job_table[job.id] = job
+    shell_state["last_job_pid"] = pid
+    if shell_state["interactive"]:
+        print(f"[{job.id}] {pid}")
+    return job
+
+def job_marker(job):
+    ids = sorted(job_table)
+    if job.id == ids[-1]:
+        return "+"
+    if len(ids) > 1 and job.id == ids[-2]:
+        return "-"
+    return " "
+
+def format_job(job):
+    command = job.command + (" &" if job.state == "Running" else "")
+    return f"[{job.id}]{job_marker(job)}  {job.state:<24}{command}"
+
+def notify_jobs():
+    """Report and forget finished jobs, as bash does before each prompt."""
+    for job in list(job_table.values()):
+        if job.returncode is not None:
+            print(format_job(job))
+            del job_table[job.id]
+
+def find_job(spec, err, name):
+    """Resolve %n, %%, %+ or %- (a bare number also works) to a Job."""
+    ids = sorted(job_table)
+    if spec in ("%%", "%+", "%", None):
+        job_id = ids[-1] if ids else None
+    elif spec == "%-":
+        job_id = ids[-2] if len(ids) > 1 else None
+    else:
+        number = spec[1:] if spec.startswith("%") else spec
+        job_id = int(number) if number.isdigit() else None
+    if job_id not in job_table:
+        print(f"{name}: {spec or 'current'}: no such job", file=err)
+        return None
+    return job_table[job_id]
+
+def give_terminal(pgid):
+    """Make pgid the terminal's foreground process group, if there is a terminal."""
+    if not os.isatty(0):
+        return
+    # The shell may be in the background by now; ignore the SIGTTOU that
+    # tcsetpgrp would otherwise stop it with
+    old = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        os.tcsetpgrp(0, pgid)
+    except OSError:
+        pass
+    finally:
+        signal.signal(signal.SIGTTOU, old)
+
+def wait_for_job(job):
+    """Block until a job exits and return its shell exit status."""
+    while job.returncode is None:
+        try:
+            _, status = os.waitpid(job.pid, 0)
+        except ChildProcessError:
+            # Already collected by reap_jobs, or not our child any more
+            if job.returncode is None:
+                job.returncode = 127
+            break
+        job.update(status)
+    job_table.pop(job.id, None)
+    return exit_status(job.returncode)
+
+def jobs_builtin(args, out, err):
+    for job in list(job_table.values()):
+        print(format_job(job), file=out)
+        if job.returncode is not None:
+            del job_table[job.id]
+    return 0
+
+def wait_builtin(args, out, err):
+    if not args:
+        for job in list(job_table.values()):
+            wait_for_job(job)
+        return 0
+    status = 0
+    for spec in args:
+        if not spec.startswith("%"):
+            job = next((j for j in job_table.values() if str(j.pid) == spec), None)
+            if job is None:
+                print(f"wait: pid {spec} is not a child of this shell", file=err)
+                status = 127
+                continue
+        elif (job := find_job(spec, err, "wait")) is None:
+            status = 127
+            continue
+        status = wait_for_job(job)
+    return status
+
+def fg_builtin(args, out, err):
+    job = find_job(args[0] if args else None, err, "fg")
+    if job is None:
+        return 1
+    print(job.command, file=out)
+    out.flush()
+    give_terminal(job.pid)
+    try:
+        os.killpg(job.pid, signal.SIGCONT)
+        job.state = "Running"
+        while job.returncode is None:
+            try:
+                _, status = os.waitpid(job.pid, os.WUNTRACED)
+            except ChildProcessError:
+                break
+            job.update(status)
+            if job.state == "Stopped":
+                print(f"\n{format_job(job)}", file=out)
+                return 128 + signal.SIGTSTP
+    finally:
+        give_terminal(os.getpgrp())
+    job_table.pop(job.id, None)
+    return exit_status(job.returncode if job.returncode is not None else 127)
+
+def bg_builtin(args, out, err):
+    job = find_job(args[0] if args else None, err, "bg")
+    if job is None:
+        return 1
+    os.killpg(job.pid, signal.SIGCONT)
+    job.state = "Running"
+    print(f"[{job.id}]{job_marker(job)} {job.command} &", file=out)
+    return 0
+
+def parse_signal(spec):
+    if spec.isdigit():
+        return int(spec)
+    name = spec.upper()
+    if not name.startswith("SIG"):
+        name = "SIG" + name
+    return signal.Signals[name]
+
+def kill_builtin(args, out, err):
+    if args and args[0] == "-l":
+        print(" ".join(s.name[3:] for s in signal.Signals if not s.name.startswith("SIG_")), file=out)
+        return 0
+    sig = signal.SIGTERM
+    try:
+        if len(args) > 1 and args[0] == "-s":
+            sig = parse_signal(args[1])
+            args = args[2:]
+        elif args and args[0].startswith("-") and len(args[0]) > 1:
+            sig = parse_signal(args[0][1:])
+            args = args[1:]
+    except KeyError:
+        print(f"kill: {args[0]}: invalid signal specification", file=err)
+        return 1
+    if not args:
+        print("kill: usage: kill [-s sigspec | -signum] pid | %job ...", file=err)
+        return 2
+    status = 0
+    for target in args:
+        try:
+            if target.startswith("%"):
+                job = find_job(target, err, "kill")
+                if job is None:
+                    status = 1
+                    continue
+                os.killpg(job.pid, sig)
+                if job.state == "Stopped" and sig in (signal.SIGTERM, signal.SIGHUP):
+                    # A stopped job only sees the signal once it runs again
+                    os.killpg(job.pid, signal.SIGCONT)
+            else:
+                os.kill(int(target), sig)
+        except ValueError:
+            print(f"kill: {target}: arguments must be process or job IDs", file=err)
+            status = 1
+        except OSError as e:
+            print(f"kill: ({target}) - {e.strerror}", file=err)
+            status = 1
+    return status
+
+# Persistent history. The log holds one command per line and is only ever
+# appended to, one write per command, so concurrent sessions interleave whole
+# records. Beside it, HISTFILE.idx holds each record's log offset as a
+# native-endian 8-byte integer: entry n lives at n*8 in the index, so counting
+# entries or fetching any one of them costs a stat and a pread no matter how
+# long the history is. Appends hold an flock on the index, and each one first
+# indexes any records a session killed between its two writes left behind.
+# The store is shared by every session, so history -c only hides the entries
+# before first from this one.
+history_state = {"log_fd": None, "idx_fd": None, "first": 0, "search": None}
+
+HISTORY_RECORD = 8
+
+def history_path():
+    return os.environ.get("HISTFILE") or os.path.join(os.path.expanduser("~"), ".pysh_history")
+
+def open_history():
+    """Open (creating if needed) the log and its index; False if unavailable."""
+    if history_state["log_fd"] is not None:
+        return True
+    path = history_path()
+    flags = os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC
+    try:
+        log_fd = os.open(path, flags, 0o600)
+    except OSError:
+        return False
+    try:
+        idx_fd = os.open(path + ".idx", flags, 0o600)
+    except OSError:
+        os.close(log_fd)
+        return False
+    history_state["log_fd"] = log_fd
+    history_state["idx_fd"] = idx_fd
+    with HistoryLock():
+        sync_history_index()
+    return True
+
+class HistoryLock:
+    """Hold an exclusive flock on the index, serializing appends across
+    sessions."""
+
+    def __enter__(self):
+        import fcntl
+        fcntl.flock(history_state["idx_fd"], fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        import fcntl
+        fcntl.flock(history_state["idx_fd"], fcntl.LOCK_UN)
+
+def indexed_log_end():
+    """Where the record after the last indexed one starts, or None if the
+    log is shorter than the index says (it was truncated elsewhere)."""
+    count = history_count()
+    if count == 0:
+        return 0
+    offset = history_offsets(count - 1, 1)[0]
+    if offset >= os.fstat(history_state["log_fd"]).st_size:
+        return None
+    while chunk := os.pread(history_state["log_fd"], IO_CHUNK, offset):
+        end = chunk.find(b"\n")
+        if end != -1:
+            return offset + end + 1
+        offset += len(chunk)
+    return offset
+
+def sync_history_index():
+    """Index the records past the last indexed one, rebuilding the index if
+    it no longer fits the log. Called with the lock held; normally costs a
+    stat and two preads."""
+    start = indexed_log_end()
+    if start is None:
+        os.ftruncate(history_state["idx_fd"], 0)
+        start = 0
+    if start >= os.fstat(history_state["log_fd"]).st_size:
+        return
+    log = map_history_log()
+    if log is None:
+        return
+    with log:
+        offsets = bytearray()
+        while start < len(log):
+            offsets += start.to_bytes(HISTORY_RECORD, sys.byteorder)
+            end = log.find(b"\n", start)
+            start = len(log) if end == -1 else end + 1
+    os.write(history_state["idx_fd"], offsets)
+
+def map_history_log():
+    """Map the whole log read-only, or None while it is empty."""
+    try:
+        return mmap.mmap(history_state["log_fd"], 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return None
+
+def history_count():
+    return os.fstat(history_state["idx_fd"]).st_size // HISTORY_RECORD
+
+def history_offsets(first, count):
+    data = os.pread(history_state["idx_fd"], count * HISTORY_RECORD, first * HISTORY_RECORD)
+    return memoryview(data[:len(data) - len(data) % HISTORY_RECORD]).cast("Q")
+
+def history_record(log, offset):
+    end = log.find(b"\n", offset)
+    return log[offset:end if end != -1 else len(log)].decode("utf-8", "surrogateescape")
+
+def history_entries(first, count):
+    """Entries first .. first+count-1 (0-based) as (number, line) pairs."""
+    log = map_history_log()
+    if log is None:
+        return []
+    with log:
+        return [(first + i + 1, history_record(log, offset))
+                for i, offset in enumerate(history_offsets(first, count)) if offset < len(log)]
+
+def history_size():
+    try:
+        return max(0, int(os.environ.get("HISTSIZE", "1000")))
+    except ValueError:
+        return 1000
+
+def load_history():
+    """Give readline the last HISTSIZE entries; the rest stay on disk."""
+    if not open_history():
+        return
+    count = history_count()
+    size = history_size()
+    for _, line in history_entries(max(0, count - size), size):
+        readline.add_history(line)
+
+def append_history(line):
+    if not line.strip() or history_state["log_fd"] is None:
+        return
+    record = line.encode("utf-8", "surrogateescape") + b"\n"
+    log_fd = history_state["log_fd"]
+    with HistoryLock():
+        sync_history_index()
+        os.write(log_fd, record)
+        # O_APPEND leaves our file position just past our own record,
+        # whatever other sessions have appended since
+        offset = os.lseek(log_fd, 0, os.SEEK_CUR) - len(record)
+        os.write(history_state["idx_fd"], offset.to_bytes(HISTORY_RECORD, sys.byteorder))
+
+def visible_log_start(log):
+    """Offset of the first entry this session still shows."""
+    first = history_state["first"]
+    if first == 0:
+        return 0
+    offsets = history_offsets(first, 1)
+    return offsets[0] if offsets else len(log)
+
+def search_history(text, prefix=True):
+    """Most recent entry starting with (or containing) text, from the whole log."""
+    found = find_history(text, prefix)
+    return None if found is None else found[1]
+
+def find_history(text, prefix=True, before=None):
+    """The (offset, line) of the most recent entry starting with (or
+    containing) text among those that end before offset before."""
+    log = map_history_log()
+    if log is None:
+        return None
+    needle = text.encode("utf-8", "surrogateescape")
+    if not needle:
+        return None
+    with log:
+        start = visible_log_start(log)
+        end = len(log) if before is None else before
+        # rfind scans the mapped log backwards in C; only the matching
+        # record is ever decoded
+        if prefix:
+            pos = log.rfind(b"\n" + needle, max(start - 1, 0), end)
+            if pos != -1:
+                return pos + 1, history_record(log, pos + 1)
+            if start == 0 and len(needle) <= end and log[:len(needle)] == needle:
+                return 0, history_record(log, 0)
+            return None
+        pos = log.rfind(needle, start, end)
+        if pos == -1:
+            return None
+        offset = log.rfind(b"\n", 0, pos) + 1
+        return offset, history_record(log, offset)
+
+# Ctrl-R is a readline macro that puts this in front of the line and
+# accepts it, since readline cannot call back into Python for a key
+HISTORY_SEARCH_MARK = "\x1e"
+
+def reverse_search(text):
+    """Ctrl-R: find the most recent entry containing text in the whole
+    store and return (needle, entry) for the next prompt to edit, or None.
+
+    Pressing Ctrl-R again on the entry it found carries on with older
+    matches for the same needle.
+    """
+    state = history_state["search"]
+    if state is not None and text == state[1]:
+        needle, before = state[0], state[2]
+    else:
+        needle, before = text, None
+    found = find_history(needle, prefix=False, before=before)
+    if found is None:
+        history_state["search"] = None
+        return None
+    offset, line = found
+    history_state["search"] = (needle, line, offset)
+    return needle, line
+
+def clear_history():
+    """Forget the history in this session only; other sessions share the
+    store, so it is left alone."""
+    history_state["first"] = history_count()
+    if readline is not None:
+        readline.clear_history()
+
+HISTORY_EVENT_RE = re.compile(r"!(!|-?\d+|\?[^?\n]*\??|[^\s=(;&|<>]+)")
+
+def expand_history(line):
+    """Expand a leading !!, !n, !-n, !prefix or !?text? from the history store.
+
+    Returns the expanded line, or None with a message printed when the
+    event is not found.
+    """
+    match = HISTORY_EVENT_RE.match(line)
+    if match is None or history_state["log_fd"] is None:
+        return line
+    event = match.group(1)
+    found = None
+    if event == "!" or event.lstrip("-").isdigit():
+        count = history_count()
+        number = -1 if event == "!" else int(event)
+        index = count + number if number < 0 else number - 1
+        if history_state["first"] <= index < count:
+            found = next((l for _, l in history_entries(index, 1)), None)
+    elif event.startswith("?"):
+        found = search_history(event[1:].rstrip("?"), prefix=False)
+    else:
+        found = search_history(event)
+    if found is None:
+        print(f"{match.group(0)}: event not found", file=sys.stderr)
+        return None
+    line = found + line[match.end():]
+    print(line)
+    return line
+
+def history_builtin(args, out, err):
+    if history_state["log_fd"] is None:
+        return 0
+    if args and args[0] == "-c":
+        clear_history()
+        return 0
+    count = history_count()
+    visible = count - history_state["first"]
+    size = min(visible, history_size())
+    if args:
+        if not args[0].isdigit():
+            print(f"history: {args[0]}: numeric argument required", file=err)
+            return 1
+        size = min(visible, int(args[0]))
+    for number, line in history_entries(count - size, size):
+        print(f"{number:5d}  {line}", file=out)
+    return 0
+
+class ShellSyntaxError(Exception):
+    pass
+
+class IncompleteCommand(ShellSyntaxError):
+    """The input ended inside a quote, $(...) or compound command, so more
+    lines are needed before it can run.
+
+    needs_closer is set when it ended inside a compound command, which no
+    line without a closing fi, done, } or ) can complete.
+    """
+
+    def __init__(self, message, needs_closer=False):
+        super().__init__(message)
+        self.needs_closer = needs_closer
+
+# Whether a line might hold one of the words that close a compound command.
+# False positives only cost a parse.
+CLOSER_RE = re.compile(r"(?:^|[\s;&|(])(?:fi|done|\})(?=$|[\s;&|)])|\)")
+
+GLOB_SPECIAL_RE = re.compile(r"([*?[\]\\])")
+
+class Word:
+    """A word that needs expanding when its command runs.
+
+    parts are the (kind, value, quoted) pieces it was written as: ("text",
+    literal text), ("param", variable name) or ("command", source of a
+    $(...)). Words that are assignments to export are not split or globbed.
+    """
+    __slots__ = ("parts", "split")
+
+    def __init__(self, parts, split=True):
+        self.parts = parts
+        self.split = split
+
+    def __str__(self):
+        return "".join(value if kind == "text" else f"${{{value}}}" if kind == "param" else f"$({value})"
+                       for kind, value, _ in self.parts)
+
+class Command:
+    """A simple command: its words, its (fd, target, flags) redirections and
+    the (name, value) assignments written before it."""
+    __slots__ = ("argv", "redirects", "assigns")
+
+    def __init__(self, argv, redirects, assigns=()):
+        self.argv = argv
+        self.redirects = redirects
+        self.assigns = assigns
+
+class Pipeline:
+    """Commands joined by |; timed when prefixed with the time keyword and
+    negated when prefixed with !."""
+    __slots__ = ("commands", "timed", "negated")
+
+    def __init__(self, commands, timed=False, negated=False):
+        self.commands = commands
+        self.timed = timed
+        self.negated = negated
+
+class AndOrList:
+    """Pipelines paired with the connector ("", && or ||) that precedes them."""
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+class CommandList:
+    """(AndOrList, background) pairs from a line split on ;, & and newlines."""
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+# Compound commands. They stand in a Pipeline wherever a Command can, and
+# their bodies are CommandLists parsed once, so a loop runs the same tree on
+# every iteration and a function the same tree on every call.
+
+class If:
+    """if/elif clauses as (condition, body) pairs and the else body or None."""
+    __slots__ = ("clauses", "else_body", "redirects")
+
+    def __init__(self, clauses, else_body, redirects=()):
+        self.clauses = clauses
+        self.else_body = else_body
+        self.redirects = redirects
+
+class While:
+    """A while loop, or an until loop when until is set."""
+    __slots__ = ("condition", "body", "until", "redirects")
+
+    def __init__(self, condition, body, until=False, redirects=()):
+        self.condition = condition
+        self.body = body
+        self.until = until
+        self.redirects = redirects
+
+class For:
+    """A for loop over words, or over "$@" when words is None."""
+    __slots__ = ("name", "words", "body", "redirects")
+
+    def __init__(self, name, words, body, redirects=()):
+        self.name = name
+        self.words = words
+        self.body = body
+        self.redirects = redirects
+
+class Group:
+    """A { list; } group, or a ( list ) run in a subshell."""
+    __slots__ = ("body", "subshell", "redirects")
+
+    def __init__(self, body, subshell=False, redirects=()):
+        self.body = body
+        self.subshell = subshell
+        self.redirects = redirects
+
+class FunctionDef:
+    """name() compound-command; running it defines the function."""
+    __slots__ = ("name", "body", "redirects")
+
+    def __init__(self, name, body):
+        self.name = name
+        self.body = body
+        self.redirects = ()
+
+# One alternative per lexical element; the lexer walks the line once,
+# matching these in order at each position.
+TOKEN_RE = re.compile(r"""
+    (?P<space>[ \t]+)
+  | (?P<single>'[^']*')
+  | (?P<double>")
+  | (?P<dollar>\$)
+  | (?P<escape>\\.?)
+  | (?P<comment>\#[^\n]*)
+  | (?P<op>&&|\|\||>>|>&|<&|[|&;<>()\n])
+  | (?P<ionumber>\d+(?=[<>]))
+  | (?P<plain>[^ \t\n'"\\|&;<>()$]+)
+  | (?P<unterminated>')
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Inside double quotes: literal runs, backslash escapes, $ and the closing quote
+DOUBLE_QUOTE_RE = re.compile(r'[^"\\$]+|\\(.)|\\|\$|"', re.DOTALL)
+
+DOUBLE_QUOTE_ESCAPES = '\\"$`\n'
+
+# $name, ${name}, the special parameters, and the start of $(
+DOLLAR_RE = re.compile(r"\$(?:\{([A-Za-z_][A-Za-z0-9_]*|[0-9]+|[?!$#@*])\}|([A-Za-z_][A-Za-z0-9_]*|[?!$#@*0-9])|(\())")
+
+ASSIGN_RE = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)=")
+
+REDIRECT_OPS = {">": REDIRECT_TRUNC, ">>": REDIRECT_APPEND, "<": REDIRECT_READ,
+                ">&": REDIRECT_DUP, "<&": REDIRECT_DUP}
+
+REDIRECT_OP_RE = re.compile(r">>|>&|<&|[<>]")
+
+def tokenize(line):
+    """Split a line into ("word", text), ("assign", (name, value)), ("op", op)
+    and ("redirect", (fd, op)) tokens.
+
+    fd is None for a redirection with no explicit fd number. A word (or an
+    assignment's value) is a str, or a Word when it has expansions or
+    unquoted pattern characters. Any word of the form name=value comes out
+    as an assignment; the parser turns it back into a word where it is not
+    one.
+    """
+    tokens = []
+    word = []
+    in_word = False
+    pos = 0
+    while pos < len(line):
+        m = TOKEN_RE.match(line, pos)
+        kind, text = m.lastgroup, m.group()
+        pos = m.end()
+        if kind == "unterminated":
+            raise IncompleteCommand(f"unexpected EOF while looking for matching `{text}'")
+        if kind == "escape" and text == "\\":
+            # A backslash ending the input continues it on the next line
+            raise IncompleteCommand("syntax error: unexpected end of file")
+        if kind == "escape" and text == "\\\n":
+            # A line continuation joins the lines, inside a word or not
+            continue
+        if kind == "comment" and in_word:
+            # A # inside a word is literal; only the # itself is consumed
+            word.append(("text", "#", False))
+            pos = m.start() + 1
+            continue
+        if kind in ("space", "comment", "op"):
+            if in_word:
+                tokens.append(word_token(word))
+                word = []
+                in_word = False
+            if kind == "op":
+                if text in REDIRECT_OPS:
+                    tokens.append(("redirect", (None, text)))
+                else:
+                    tokens.append(("op", text))
+            continue
+        if kind == "ionumber" and not in_word:
+            op = REDIRECT_OP_RE.match(line, pos).group()
+            tokens.append(("redirect", (int(text), op)))
+            pos += len(op)
+            continue
+        in_word = True
+        if kind == "single":
+            word.append(("text", text[1:-1], True))
+        elif kind == "double":
+            pos = scan_double_quoted(line, pos, word)
+        elif kind == "dollar":
+            pos = scan_dollar(line, m.start(), word, False)
+        elif kind == "escape":
+            word.append(("text", text[1:], True))
+        else:
+            word.append(("text", text, False))
+    if in_word:
+        tokens.append(word_token(word))
+    return tokens
+
+def scan_double_quoted(line, pos, parts):
+    """Add the parts of a double-quoted string that opened just before pos;
+    returns the position after its closing quote."""
+    text = []
+    start = len(parts)
+    while pos < len(line):
+        m = DOUBLE_QUOTE_RE.match(line, pos)
+        chunk = m.group()
+        if chunk == '"':
+            # "" is an empty word, but "$@" must be able to vanish
+            if text or len(parts) == start:
+                parts.append(("text", "".join(text), True))
+            return m.end()
+        if chunk == "$":
+            if text:
+                parts.append(("text", "".join(text), True))
+                text = []
+            pos = scan_dollar(line, pos, parts, True)
+            continue
+        escaped = m.group(1)
+        if escaped is None:
+            text.append(chunk)
+        elif escaped in DOUBLE_QUOTE_ESCAPES:
+            # A backslash-newline inside double quotes is a line continuation
+            if escaped != "\n":
+                text.append(escaped)
+        else:
+            text.append(chunk)
+        pos = m.end()
+    raise IncompleteCommand("unexpected EOF while looking for matching `\"'")
+
+def scan_dollar(line, pos, parts, quoted):
+    """Add the expansion starting with the $ at pos; returns the position after it.
+
+    A $ that starts no expansion is literal.
+    """
+    m = DOLLAR_RE.match(line, pos)
+    if m is None:
+        if line.startswith("${", pos):
+            end = line.find("}", pos)
+            raise ShellSyntaxError(f"{line[pos:end + 1 if end != -1 else len(line)]}: bad substitution")
+        parts.append(("text", "$", quoted))
+        return pos + 1
+    if m.group(3) is None:
+        parts.append(("param", m.group(1) or m.group(2), quoted))
+        return m.end()
+    end = find_command_end(line, m.end())
+    source = line[m.end():end]
+    # Parsed now so syntax errors surface with the outer line; the result
+    # is cached for when the substitution runs. The ) has been found, so
+    # the body being cut short is an error here, not a reason to read on.
+    try:
+        parse(source)
+    except IncompleteCommand as e:
+        raise ShellSyntaxError(str(e)) from None
+    parts.append(("command", source, quoted))
+    return end + 1
+
+def find_command_end(line, pos):
+    """Index of the ) closing a $( whose body starts at pos."""
+    depth = 1
+    while pos < len(line):
+        c = line[pos]
+        if c == "\\":
+            pos += 2
+            continue
+        if c == "'":
+            end = line.find("'", pos + 1)
+            if end == -1:
+                raise IncompleteCommand("unexpected EOF while looking for matching `''")
+            pos = end + 1
+            continue
+        if c == '"':
+            pos = scan_double_quoted(line, pos + 1, [])
+            continue
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return pos
+        pos += 1
+    raise IncompleteCommand("unexpected EOF while looking for matching `)'")
+
+GLOB_MAGIC_RE = re.compile(r"[*?[]")
+
+def make_word(parts, split=True):
+    """Join a word's parts, keeping them in a Word if it needs expansion."""
+    for kind, value, quoted in parts:
+        if kind != "text" or not quoted and GLOB_MAGIC_RE.search(value):
+            return Word(tuple(parts), split)
+    return "".join(value for _, value, _ in parts)
+
+def word_token(parts):
+    kind, value, quoted = parts[0]
+    m = ASSIGN_RE.match(value) if kind == "text" and not quoted else None
+    if m is None:
+        return ("word", make_word(parts))
+    value_parts = [("text", value[m.end():], False)] + parts[1:]
+    return ("assign", (m.group(1), make_word(value_parts, split=False)))
+
+def assignment_word(name, value, split=True):
+    """Turn an assignment token back into the word it was written as."""
+    if isinstance(value, Word):
+        return Word((("text", f"{name}=", False),) + value.parts, split)
+    return f"{name}={value}"
+
+def unexpected(tokens, i):
+    token = tokens[i][1] if i < len(tokens) else "newline"
+    if isinstance(token, tuple):
+        token = token[1]
+    if token == "\n":
+        token = "newline"
+    return ShellSyntaxError(f"syntax error near unexpected token `{token}'")
+
+def parse_redirect(fd, op, word):
+    """The (fd, target, flags) redirections for one operator and its word."""
+    flags = REDIRECT_OPS[op]
+    default = 0 if op[0] == "<" else 1
+    if flags is not REDIRECT_DUP:
+        return [(default if fd is None else fd, word, flags)]
+    if isinstance(word, str) and word.isdigit():
+        return [(default if fd is None else fd, int(word), flags)]
+    if op == ">&" and fd is None:
+        # >&file sends both stdout and stderr to file, like &>file
+        return [(1, word, REDIRECT_TRUNC), (2, 1, REDIRECT_DUP)]
+    raise ShellSyntaxError(f"{word}: ambiguous redirect")
+
+# Reserved words that end a list: parse_list stops in front of them
+LIST_TERMINATORS = {"then", "elif", "else", "fi", "do", "done", "}"}
+
+END_OF_INPUT = "syntax error: unexpected end of file"
+
+def at_word(tokens, i, words):
+    """Whether tokens[i] is one of the unquoted reserved words in words."""
+    return i < len(tokens) and tokens[i][0] == "word" and isinstance(tokens[i][1], str) and tokens[i][1] in words
+
+def skip_newlines(tokens, i):
+    while i < len(tokens) and tokens[i] == ("op", "\n"):
+        i += 1
+    return i
+
+def after_operator(tokens, i):
+    """Move past an operator that needs a command after it (|, && or ||),
+    and any newlines following it."""
+    i = skip_newlines(tokens, i + 1)
+    if i >= len(tokens):
+        raise IncompleteCommand(END_OF_INPUT)
+    return i
+
+def expect(tokens, i, words):
+    """Return the reserved word at tokens[i], which must be one of words."""
+    if i >= len(tokens):
+        raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+    if not at_word(tokens, i, words):
+        raise unexpected(tokens, i)
+    return tokens[i][1]
+
+def parse_redirect_token(tokens, i):
+    """The redirections for the operator at tokens[i] and its target word."""
+    if i + 1 >= len(tokens) or tokens[i + 1][0] not in ("word", "assign"):
+        raise unexpected(tokens, i + 1)
+    target_kind, target = tokens[i + 1]
+    if target_kind == "assign":
+        target = assignment_word(*target)
+    return parse_redirect(*tokens[i][1], target)
+
+def parse_command(tokens, i):
+    compound = parse_compound(tokens, i)
+    if compound is not None:
+        return compound
+    if at_word(tokens, i, LIST_TERMINATORS):
+        raise unexpected(tokens, i)
+    argv = []
+    redirects = []
+    assigns = []
+    while i < len(tokens):
+        kind, value = tokens[i]
+        if kind == "assign" and not argv:
+            assigns.append(value)
+        elif kind == "assign":
+            # export's and local's arguments are assignments too, so they
+            # are not split
+            argv.append(assignment_word(*value, split=argv[0] not in ("export", "local")))
+        elif kind == "word":
+            argv.append(value)
+        elif kind == "redirect":
+            redirects.extend(parse_redirect_token(tokens, i))
+            i += 1
+        else:
+            break
+        i += 1
+    if not argv and not redirects and not assigns:
+        raise unexpected(tokens, i)
+    return Command(tuple(argv), tuple(redirects), tuple(assigns)), i
+
+def parse_compound(tokens, i):
+    """Parse the compound command or function definition starting at
+    tokens[i], with any redirections after it; None if there is none."""
+    if i >= len(tokens):
+        return None
+    kind, value = tokens[i]
+    if (kind, value) == ("op", "("):
+        body, i = parse_body(tokens, i + 1, (")",))
+        if i >= len(tokens):
+            raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+        command = Group(body, subshell=True)
+    elif kind != "word" or not isinstance(value, str):
+        return None
+    elif value == "if":
+        command, i = parse_if(tokens, i)
+    elif value in ("while", "until"):
+        condition, i = parse_body(tokens, i + 1, ("do",))
+        expect(tokens, i, ("do",))
+        body, i = parse_body(tokens, i + 1, ("done",))
+        expect(tokens, i, ("done",))
+        command = While(condition, body, until=value == "until")
+    elif value == "for":
+        command, i = parse_for(tokens, i)
+    elif value == "{":
+        body, i = parse_body(tokens, i + 1, ("}",))
+        expect(tokens, i, ("}",))
+        command = Group(body)
+    elif value == "function" or tokens[i + 1:i + 3] == [("op", "("), ("op", ")")]:
+        return parse_function(tokens, i)
+    else:
+        return None
+    i += 1
+    redirects = []
+    while i < len(tokens) and tokens[i][0] == "redirect":
+        redirects.extend(parse_redirect_token(tokens, i))
+        i += 2
+    command.redirects = tuple(redirects)
+    return command, i
+
+def parse_if(tokens, i):
+    """Parse if ... fi; returns the If and the index of the fi."""
+    clauses = []
+    else_body = None
+    keyword = "if"
+    while keyword == "if" or keyword == "elif":
+        condition, i = parse_body(tokens, i + 1, ("then",))
+        expect(tokens, i, ("then",))
+        body, i = parse_body(tokens, i + 1, ("elif", "else", "fi"))
+        clauses.append((condition, body))
+        keyword = expect(tokens, i, ("elif", "else", "fi"))
+    if keyword == "else":
+        else_body, i = parse_body(tokens, i + 1, ("fi",))
+        expect(tokens, i, ("fi",))
+    return If(tuple(clauses), else_body), i
+
+def parse_for(tokens, i):
+    """Parse for name [in words]; do ... done; returns the For and the index
+    of the done."""
+    i += 1
+    if i >= len(tokens):
+        raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+    name = tokens[i][1]
+    if tokens[i][0] != "word" or not isinstance(name, str):
+        raise unexpected(tokens, i)
+    if not NAME_RE.fullmatch(name):
+        raise ShellSyntaxError(f"`{name}': not a valid identifier")
+    i = skip_newlines(tokens, i + 1)
+    words = None
+    if at_word(tokens, i, ("in",)):
+        words = []
+        i += 1
+        while i < len(tokens) and tokens[i][0] in ("word", "assign"):
+            kind, value = tokens[i]
+            words.append(assignment_word(*value) if kind == "assign" else value)
+            i += 1
+        words = tuple(words)
+        if i >= len(tokens):
+            raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+        if tokens[i] not in (("op", ";"), ("op", "\n")):
+            raise unexpected(tokens, i)
+        i += 1
+    elif i < len(tokens) and tokens[i] == ("op", ";"):
+        i += 1
+    i = skip_newlines(tokens, i)
+    expect(tokens, i, ("do",))
+    body, i = parse_body(tokens, i + 1, ("done",))
+    expect(tokens, i, ("done",))
+    return For(name, words, body), i
+
+def parse_function(tokens, i):
+    """Parse name() body or function name [()] body."""
+    if tokens[i][1] == "function":
+        i += 1
+        if i >= len(tokens):
+            raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+    name = tokens[i][1]
+    if tokens[i][0] != "word" or not isinstance(name, str) or name in shell_keywords:
+        raise unexpected(tokens, i)
+    i += 1
+    if tokens[i:i + 2] == [("op", "("), ("op", ")")]:
+        i += 2
+    i = skip_newlines(tokens, i)
+    body = parse_compound(tokens, i)
+    if body is None or isinstance(body[0], FunctionDef):
+        if i >= len(tokens):
+            raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+        raise unexpected(tokens, i)
+    return FunctionDef(name, body[0]), body[1]
+
+def parse_pipeline(tokens, i):
+    timed = at_word(tokens, i, ("time",))
+    if timed:
+        i += 1
+    negated = at_word(tokens, i, ("!",))
+    if negated:
+        i += 1
+    command, i = parse_command(tokens, i)
+    commands = [command]
+    while i < len(tokens) and tokens[i] == ("op", "|"):
+        command, i = parse_command(tokens, after_operator(tokens, i))
+        commands.append(command)
+    return Pipeline(tuple(commands), timed, negated), i
+
+def parse_and_or(tokens, i):
+    pipeline, i = parse_pipeline(tokens, i)
+    items = [("", pipeline)]
+    while i < len(tokens) and tokens[i] in (("op", "&&"), ("op", "||")):
+        connector = tokens[i][1]
+        pipeline, i = parse_pipeline(tokens, after_operator(tokens, i))
+        items.append((connector, pipeline))
+    return AndOrList(tuple(items)), i
+
+def parse_list(tokens, i, stops=()):
+    """Parse and-or lists separated by ;, & or newlines, up to the end of
+    the tokens or one of the reserved words (or ")") in stops."""
+    items = []
+    while True:
+        i = skip_newlines(tokens, i)
+        if i >= len(tokens) or at_word(tokens, i, stops) or ")" in stops and tokens[i] == ("op", ")"):
+            break
+        and_or, i = parse_and_or(tokens, i)
+        background = False
+        if i < len(tokens) and tokens[i] in (("op", ";"), ("op", "&"), ("op", "\n")):
+            background = tokens[i][1] == "&"
+            i += 1
+        elif i < len(tokens) and not at_word(tokens, i, stops) and tokens[i] != ("op", ")"):
+            raise unexpected(tokens, i)
+        items.append((and_or, background))
+    return CommandList(tuple(items)), i
+
+def parse_body(tokens, i, stops):
+    """parse_list for the body of a compound command, which must not be empty."""
+    body, i = parse_list(tokens, i, stops)
+    if not body.items:
+        if i >= len(tokens):
+            raise IncompleteCommand(END_OF_INPUT, needs_closer=True)
+        raise unexpected(tokens, i)
+    return body, i
+
+@functools.lru_cache(maxsize=1024)
+def parse(line):
+    """Parse a command line (or several, joined by newlines) into a CommandList.
+
+    Results are cached by source line, so lines repeated in loops and
+    scripts are never re-tokenized. The returned tree is shared and must
+    not be modified. Raises IncompleteCommand when the source ends inside
+    a construct that more lines could complete.
+    """
+    tokens = tokenize(line)
+    command_list, i = parse_list(tokens, 0)
+    if i < len(tokens):
+        raise unexpected(tokens, i)
+    return command_list
+
+def timed_parse(line):
+    """parse(), recording how long it took for the trace."""
+    start = time.perf_counter()
+    try:
+        return parse(line)
+    finally:
+        shell_state["parse_s"] = time.perf_counter() - start
+
+def run_line(line):
+    """Parse and run one line of input, returning its exit status."""
+    try:
+        command_list = timed_parse(line)
+    except ShellSyntaxError as e:
+        print(f"{e}", file=sys.stderr)
+        shell_state["last_status"] = 2
+        return 2
+    return run_list(command_list)
+
+def run_batch(lines, errexit=False):
+    """Run lines without a prompt and return the last exit status.
+
+    Lines are gathered until they make a complete command, so compound
+    commands and quotes may span several. Like a non-interactive bash, a
+    syntax error ends the run; with errexit so does the first command that
+    fails outside a condition (see run_list).
+    """
+    shell_state["errexit"] = errexit
+    pending = None
+    needs_closer = False
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", "surrogateescape")
+        line = line.rstrip("\n")
+        source = line if pending is None else f"{pending}\n{line}"
+        if needs_closer and not CLOSER_RE.search(line):
+            # Reparsing the whole construct for every line of a long
+            # function body would make reading it quadratic
+            pending = source
+            continue
+        try:
+            command_list = timed_parse(source)
+        except IncompleteCommand as e:
+            pending = source
+            needs_closer = e.needs_closer
+            continue
+        except ShellSyntaxError as e:
+            print(f"{e}", file=sys.stderr)
+            shell_state["last_status"] = 2
+            break
+        pending = None
+        needs_closer = False
+        run_list(command_list)
+    else:
+        if pending is not None:
+            run_line(pending)
+    return shell_state["last_status"]
+
+def stdin_lines(fd=0):
+    """Read commands from stdin without taking input meant for them.
+
+    The commands we run share fd 0, so it must sit just past the last line
+    read whenever one runs, as in sh. A seekable stdin is still read in
+    large chunks, with the offset moved back to the end of each line before
+    it is handed out; a command that reads from it moves the offset on, and
+    reading resumes from there. A pipe cannot be rewound, so it is read a
+    byte at a time.
+    """
+    try:
+        pos = os.lseek(fd, 0, os.SEEK_CUR)
+    except OSError:
+        pos = None
+    if pos is None:
+        line = bytearray()
+        while byte := os.read(fd, 1):
+            line += byte
+            if byte == b"\n":
+                yield bytes(line)
+                line = bytearray()
+        if line:
+            yield bytes(line)
+        return
+    buf = b""
+    start = 0  # buf[start:] is the unread input, beginning at offset pos
+    while True:
+        end = buf.find(b"\n", start) + 1
+        if not end:
+            os.lseek(fd, pos + len(buf) - start, os.SEEK_SET)
+            chunk = os.read(fd, BATCH_BUFFER)
+            if not chunk:
+                break
+            buf = buf[start:] + chunk
+            start = 0
+            continue
+        line = buf[start:end]
+        start = end
+        pos += len(line)
+        os.lseek(fd, pos, os.SEEK_SET)
+        yield line
+        offset = os.lseek(fd, 0, os.SEEK_CUR)
+        if offset != pos:
+            # A command read some of the input itself; carry on after it
+            pos = offset
+            buf = b""
+            start = 0
+    if start < len(buf):
+        yield buf[start:]
+
+# Server mode. One warm shell listens on a Unix socket and forks a child per
+# request, so a client pays for neither interpreter startup nor importing
+# this module. A request is a 4-byte big-endian length and a JSON object
+# {"line", "cwd", "env", "errexit"}, sent with the client's stdin, stdout and
+# stderr attached as SCM_RIGHTS fds. The child reads the request, installs
+# those fds as its 0/1/2, so output goes straight to the client's own
+# terminal or pipes, then replies with the exit status as a decimal line.
+# Reading in the child means a client that connects and sends nothing only
+# ties up its own child until the request timeout. Before replying, the
+# child reports its line and hash table to the parent over a pipe, one JSON
+# line, so the parse cache and the hash table stay warm for later requests.
+SERVER_MAX_CLIENTS = 64
+SERVER_REQUEST_TIMEOUT = 5.0
+SERVER_REQUEST_MAX = 1 << 24
+
+# Largest report a child sends back; it must fit in the pipe's buffer, since
+# nothing reads the pipe while the child writes
+SERVER_REPORT_MAX = 1 << 16
+
+def read_request(conn):
+    """Read one request; returns (payload dict, [stdin, stdout, stderr] fds)."""
+    import socket
+    data, fds, _, _ = socket.recv_fds(conn, IO_CHUNK, 3)
+    try:
+        if len(fds) != 3 or len(data) < 4:
+            raise ValueError("malformed request")
+        size = int.from_bytes(data[:4], "big")
+        if size > SERVER_REQUEST_MAX:
+            raise ValueError("request too large")
+        data = bytearray(data[4:])
+        while len(data) < size:
+            chunk = conn.recv(min(IO_CHUNK, size - len(data)))
+            if not chunk:
+                raise ValueError("truncated request")
+            data += chunk
+        import json
+        payload = json.loads(data)
+        if not valid_request(payload):
+            raise ValueError("malformed request")
+        return payload, fds
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+
+def valid_request(payload):
+    if not isinstance(payload, dict) or not isinstance(payload.get("line"), str):
+        return False
+    env = payload.get("env", {})
+    if not isinstance(env, dict) or not all(isinstance(k, str) and isinstance(v, str) for k, v in env.items()):
+        return False
+    return isinstance(payload.get("cwd", ""), str)
+
+def serve_connection(conn, report_fd):
+    """In the forked child: read the client's request and serve it. Never
+    returns, whatever the client sent."""
+    try:
+        conn.settimeout(SERVER_REQUEST_TIMEOUT)
+        payload, fds = read_request(conn)
+        conn.settimeout(None)
+    except Exception as e:
+        print(f"server: {e}", file=sys.stderr)
+        os._exit(1)
+    serve_request(conn, payload, fds, report_fd)
+
+def send_report(report_fd, line):
+    """In the forked child: tell the server the line and the hash table it
+    ended with. The line is left out if the report would not fit."""
+    import json
+    report = {"line": line, "path": command_hash["path"], "entries": command_hash["entries"]}
+    data = json.dumps(report).encode() + b"\n"
+    if len(data) > SERVER_REPORT_MAX:
+        report["line"] = ""
+        data = json.dumps(report).encode() + b"\n"
+    try:
+        if len(data) <= SERVER_REPORT_MAX:
+            os.write(report_fd, data)
+    finally:
+        os.close(report_fd)
+
+def absorb_report(data):
+    """In the server: adopt what a child learned. Entries for the same PATH
+    are merged; a child that ran with another PATH replaces the table."""
+    import json
+    try:
+        report = json.loads(data)
+        if report["path"] != command_hash["path"]:
+            command_hash["path"] = report["path"]
+            command_hash["entries"] = {}
+        command_hash["entries"].update(report["entries"])
+        for line in report["line"].splitlines():
+            parse(line)
+    except Exception:
+        # A line that does not parse, or that nests too deeply to, is
+        # simply not cached
+        pass
+
+def collect_reports(children):
+    """Read whatever the running children have reported so far, without
+    blocking. A child's background jobs may hold its pipe open long after
+    it exits, so a report ends at its newline rather than at EOF."""
+    for report in children.values():
+        fd, buf = report
+        if fd is None:
+            continue
+        try:
+            while chunk := os.read(fd, IO_CHUNK):
+                buf += chunk
+        except BlockingIOError:
+            if not buf.endswith(b"\n"):
+                continue
+        os.close(fd)
+        report[0] = None
+        if buf.endswith(b"\n"):
+            absorb_report(buf)
+        buf.clear()
+
+def serve_request(conn, payload, fds, report_fd):
+    """In the forked child: adopt the client's fds, cwd and environment, run
+    the line and send back its status."""
+    status = 1
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        if "env" in payload:
+            os.environ.clear()
+            os.environ.update(payload["env"])
+        cwd = payload.get("cwd")
+        try:
+            if cwd:
+                os.chdir(cwd)
+        except OSError as e:
+            print(f"cd: {cwd}: {e.strerror}", file=sys.stderr)
+        else:
+            status = run_batch(payload["line"].splitlines(), bool(payload.get("errexit")))
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Reported before replying, so the next request from the same
+            # client already finds it
+            send_report(report_fd, payload["line"])
+            conn.sendall(f"{status}\n".encode())
+        except Exception:
+            pass
+        os._exit(0)
+
+def reap_servers(children, block):
+    """Collect finished request children and their reports; with block, wait
+    for at least one. children maps pid -> [report fd, bytes read so far]."""
+    while children:
+        try:
+            pid, _ = os.waitpid(-1, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            pid = None
+        if pid == 0:
+            break
+        collect_reports(children)
+        if pid is None:
+            finished = list(children)
+        else:
+            finished = [pid] if pid in children else []
+        for pid in finished:
+            fd, _ = children.pop(pid)
+            if fd is not None:
+                os.close(fd)
+        if not finished:
+            break
+        block = False
+    collect_reports(children)
+
+def serve(path, max_clients=SERVER_MAX_CLIENTS):
+    """Listen on a Unix socket and run client requests, at most max_clients at
+    a time; further clients wait in the listen backlog."""
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    # The socket file is created owner-only, with no window in which
+    # another user could connect
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    except OSError as e:
+        print(f"{path}: {e.strerror}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        os.umask(umask)
+    sock.listen(socket.SOMAXCONN)
+    refresh_completion_index()
+    # Let kill and service managers stop the server cleanly, removing the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    children = {}
+    try:
+        while True:
+            reap_servers(children, block=len(children) >= max_clients)
+            if len(children) >= max_clients:
+                continue
+            conn, _ = sock.accept()
+            # Pick up reports that arrived while waiting for this client
+            collect_reports(children)
+            with conn:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                report_read, report_write = os.pipe()
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    sock.close()
+                    os.close(report_read)
+                    for fd, _ in children.values():
+                        if fd is not None:
+                            os.close(fd)
+                    serve_connection(conn, report_write)
+                os.close(report_write)
+                os.set_blocking(report_read, False)
+                children[pid] = [report_read, bytearray()]
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def init_readline():
+    """Import readline (pyreadline3 on Windows) the first time a prompt is shown."""
+    global readline
+    try:
+        import readline
+    except ImportError:
+        import pyreadline3 as readline
+
+def repl():
+    shell_state["interactive"] = True
+    init_readline()
+    readline.set_completer(completer)
+    readline.set_completer_delims(" \t\n;|&<>")
+    readline.parse_and_bind("tab: complete")
+    # Ctrl-R, !prefix and !?text search the whole store, not just the
+    # entries loaded into readline; readline's own incremental search stays
+    # on Ctrl-S
+    readline.parse_and_bind(r'"\C-r": "\C-a\C-v\036\C-m"')
+    readline.parse_and_bind(r'"\C-s": reverse-search-history')
+    load_history()
+    pending = None  # Lines of a command that is not complete yet
+    prompt = None  # Set for the prompt after a Ctrl-R search
+    while True:
+        notify_jobs()
+        prefetch_directory(".")
+        if prompt is None:
+            prompt = "$ " if pending is None else "> "
+        sys.stdout.write(prompt)
+        sys.stdout.flush()
+        prompt = None
+        try:
+            line = input()
+        except EOFError:
+            if pending is not None:
+                run_line(pending)
+            break
+        finally:
+            readline.set_startup_hook(None)
+        if line.startswith(HISTORY_SEARCH_MARK):
+            readline.remove_history_item(readline.get_current_history_length() - 1)
+            line = line[len(HISTORY_SEARCH_MARK):]
+            found = reverse_search(line) if history_state["log_fd"] is not None else None
+            if found is None:
+                sys.stdout.write("\a")
+            else:
+                needle, line = found
+                prompt = f"(reverse-search)`{needle}': "
+            readline.set_startup_hook(lambda text=line: readline.insert_text(text))
+            continue
+        tab_state["last_prefix"] = None
+        tab_state["tab_count"] = 0
+        tab_state["matches"] = []
+        expanded = expand_history(line)
+        if expanded is None:
+            shell_state["last_status"] = 1
+            continue
+        if expanded != line:
+            # Keep the expansion, not the !event, in readline's list
+            readline.replace_history_item(readline.get_current_history_length() - 1, expanded)
+        append_history(expanded)
+        source = expanded if pending is None else f"{pending}\n{expanded}"
+        try:
+            parse(source)
+        except IncompleteCommand:
+            pending = source
+            continue
+        except ShellSyntaxError:
+            pass
+        pending = None
+        run_line(source)
+
+def usage_error(message):
+    print(message, file=sys.stderr)
+    print("usage: main.py [-e] [-c command | script]", file=sys.stderr)
+    print("       main.py --server socket [--max-clients n]", file=sys.stderr)
+    sys.exit(2)
+
+def main(argv=None):
+    """Start the shell.
+
+    With -c or a script argument, or when stdin is not a terminal, commands
+    run in batch mode: no readline and no prompt. Scripts are read in large
+    buffered chunks and stdin as described in stdin_lines. -e stops at the
+    first command that fails.
+
+    --server socket runs no commands itself but serves requests from
+    app/client.py over that Unix socket.
+    """
+    args = list(sys.argv[1:] if argv is None else argv)
+    signal.signal(signal.SIGCHLD, reap_jobs)
+    # Each level of shell function call is a handful of Python frames
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), FUNCTION_NEST_MAX * 20))
+    errexit = False
+    command = None
+    server = None
+    max_clients = SERVER_MAX_CLIENTS
+    while args and args[0].startswith("-") and args[0] != "-":
+        opt = args.pop(0)
+        if opt == "--":
+            break
+        if opt in ("--server", "--max-clients"):
+            if not args:
+                usage_error(f"{opt}: option requires an argument")
+            value = args.pop(0)
+            if opt == "--server":
+                server = value
+            elif value.isdigit() and int(value) > 0:
+                max_clients = int(value)
+            else:
+                usage_error(f"{opt}: {value}: invalid number")
+            continue
+        for flag in opt[1:]:
+            if flag == "e":
+                errexit = True
+            elif flag == "c":
+                if not args:
+                    usage_error("-c: option requires an argument")
+                command = args.pop(0)
+            else:
+                usage_error(f"-{flag}: invalid option")
+
+    if server is not None:
+        serve(server, max_clients)
+        return
+    if command is not None:
+        sys.exit(run_batch(command.splitlines(), errexit))
+    if args:
+        shell_state["positional"] = args[1:]
+        try:
+            script = open(args[0], "rb", buffering=BATCH_BUFFER)
+        except OSError as e:
+            print(f"{args[0]}: {e.strerror}", file=sys.stderr)
+            sys.exit(127)
+        with script:
+            sys.exit(run_batch(script, errexit))
+    if not os.isatty(sys.stdin.fileno()):
+        sys.exit(run_batch(stdin_lines(sys.stdin.fileno()), errexit))
+    repl()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
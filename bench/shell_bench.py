@@ -0,0 +1,325 @@
+"""Benchmarks for the shell in app/main.py.
+
+Every scenario drives the shell non-interactively (-c or a script file) in
+a child process, so wall time and peak RSS come from that child's wait4
+rusage. Results are printed and can be saved as JSON and compared with an
+earlier run:
+
+    python bench/shell_bench.py --json new.json --compare old.json
+
+--quick shrinks every scenario for a fast smoke run; --large-mb sets the
+size of the large pipeline payload (2 GiB by default).
+
+--check-startup measures only the cost of importing app.main (from
+python -X importtime) and exits non-zero when it is over the budget:
+
+    python bench/shell_bench.py --check-startup
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHELL = [sys.executable, "-m", "app.main"]
+MB = 1 << 20
+
+# Cumulative import time of app.main, in milliseconds, that --check-startup
+# allows. Importing subprocess, json, concurrent.futures or readline at
+# module level again pushes the shell well past it.
+STARTUP_BUDGET_MS = 25
+
+
+def run_child(argv, env=None, capture=None):
+    """Run argv from the repo root; returns (seconds, peak RSS in KiB, status, output).
+
+    stdout is discarded unless capture names the fd (1 or 2) to collect.
+    """
+    actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0)]
+    read_fd = None
+    if capture:
+        read_fd, write_fd = os.pipe()
+        actions.append((os.POSIX_SPAWN_DUP2, write_fd, capture))
+    if capture != 1:
+        actions.append((os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0))
+    start = time.perf_counter()
+    pid = os.posix_spawn(argv[0], argv, env or os.environ, file_actions=actions)
+    output = b""
+    if capture:
+        os.close(write_fd)
+        while chunk := os.read(read_fd, 1 << 16):
+            output += chunk
+        os.close(read_fd)
+    _, status, rusage = os.wait4(pid, 0)
+    elapsed = time.perf_counter() - start
+    return elapsed, rusage.ru_maxrss, os.waitstatus_to_exitcode(status), output
+
+
+def run_shell(args, env=None, repeat=3):
+    """Run the shell repeat times; returns the best time and the largest peak RSS."""
+    cwd = os.getcwd()
+    os.chdir(REPO)
+    try:
+        runs = [run_child(SHELL + args, env) for _ in range(repeat)]
+    finally:
+        os.chdir(cwd)
+    return min(r[0] for r in runs), max(r[1] for r in runs), runs[-1][2], runs[-1][3]
+
+
+def shell_env(**overrides):
+    env = dict(os.environ)
+    env.update(overrides)
+    return env
+
+
+def write_script(directory, name, lines):
+    path = os.path.join(directory, name)
+    with open(path, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+    return path
+
+
+def import_time_ms(repeat=5):
+    """Best cumulative -X importtime figure for app.main, in milliseconds."""
+    argv = [sys.executable, "-X", "importtime", "-c", "import app.main"]
+    best = None
+    cwd = os.getcwd()
+    os.chdir(REPO)
+    try:
+        for _ in range(repeat):
+            _, _, _, output = run_child(argv, capture=2)
+            for line in output.decode().splitlines():
+                fields = line.split("|")
+                if len(fields) == 3 and fields[2].strip() == "app.main":
+                    us = int(fields[1])
+                    best = us if best is None else min(best, us)
+    finally:
+        os.chdir(cwd)
+    return best / 1e3
+
+def bench_startup(tmp):
+    """Import cost of app.main and wall time of a shell that runs nothing."""
+    empty = write_script(tmp, "empty.sh", [])
+    elapsed, rss, _, _ = run_shell([empty], repeat=5)
+    return {"startup": {"import_ms": import_time_ms(), "ms": elapsed * 1e3, "peak_rss_kb": rss}}
+
+# Per-command scenarios double their command count, up to this many, until
+# the commands take NOISE_MARGIN times longer than startup varies by
+MAX_COMMANDS = 256000
+NOISE_MARGIN = 10
+
+
+def startup_baseline(tmp, runs=5):
+    """Wall time of a shell that runs nothing: (best, spread across runs)."""
+    empty = write_script(tmp, "empty.sh", [])
+    times = [run_shell([empty], repeat=1)[0] for _ in range(runs)]
+    return min(times), max(times) - min(times)
+
+
+def bench_per_command(tmp, name, line, count, baseline, env=None):
+    """Cost of one line, from a script repeating it, with startup subtracted.
+
+    noise_us is how much startup varies, divided over the same number of
+    commands; the result is only as good as that. The count grows until
+    the signal is well clear of it, so the result is never just jitter.
+    """
+    startup, spread = baseline
+    while True:
+        script = write_script(tmp, f"{name}.sh", [line] * count)
+        elapsed, rss, _, _ = run_shell([script], env)
+        if elapsed - startup >= NOISE_MARGIN * spread or count >= MAX_COMMANDS:
+            break
+        count *= 2
+    return {
+        "commands": count,
+        "us_per_command": (elapsed - startup) / count * 1e6,
+        "noise_us": spread / count * 1e6,
+        "peak_rss_kb": rss,
+    }
+
+
+def bench_spawn(tmp, count):
+    """Per-command latency for builtins and externals, startup subtracted.
+
+    The external is /bin/true by path, since true is also a builtin.
+    """
+    baseline = startup_baseline(tmp)
+    results = {}
+    for name, line in (("builtin", "echo spawn"), ("external", "/bin/true")):
+        results[f"spawn_{name}"] = bench_per_command(tmp, f"spawn_{name}", line, count, baseline)
+    for launcher in ("subprocess", "posix_spawn"):
+        results[f"spawn_external_{launcher}"] = bench_per_command(
+            tmp, "spawn_external", "/bin/true", count, baseline, shell_env(PYSH_LAUNCHER=launcher))
+    return results
+
+
+def bench_pipelines(sizes):
+    """MB/s through 2, 4 and 8 stage pipelines of cat."""
+    results = {}
+    for label, size in sizes:
+        for stages in (2, 4, 8):
+            for native in ("1", "0"):
+                line = " | ".join([f"head -c {size} /dev/zero"] + ["cat"] * (stages - 2) + ["wc -c"])
+                repeat = 3 if size <= 64 * MB else 1
+                elapsed, rss, status, _ = run_shell(["-c", line], shell_env(PYSH_NATIVE_UTILS=native), repeat)
+                results[f"pipeline_{stages}_{label}_native{native}"] = {
+                    "bytes": size,
+                    "seconds": elapsed,
+                    "mb_per_s": size / MB / elapsed,
+                    "status": status,
+                    "peak_rss_kb": rss,
+                }
+    return results
+
+
+def completion_worker(path_dirs, calls):
+    """Runs inside the child: time completion lookups against PATH."""
+    sys.path.insert(0, REPO)
+    os.environ["PATH"] = os.pathsep.join(path_dirs)
+    from app import main
+    start = time.perf_counter()
+    main.get_executable_completions("x")
+    cold = time.perf_counter() - start
+    prefixes = [f"cmd{i % 100:02d}" for i in range(calls)]
+    start = time.perf_counter()
+    for prefix in prefixes:
+        main.get_executable_completions(prefix)
+    warm = (time.perf_counter() - start) / calls
+    print(json.dumps({"cold_ms": cold * 1e3, "warm_us": warm * 1e6}))
+
+
+def make_executables(root, count, per_dir=5000):
+    dirs = []
+    for i in range(0, count, per_dir):
+        directory = os.path.join(root, f"bin{i // per_dir}")
+        os.makedirs(directory)
+        for j in range(i, min(count, i + per_dir)):
+            path = os.path.join(directory, f"cmd{j:05d}")
+            with open(path, "w"):
+                pass
+            os.chmod(path, 0o755)
+        dirs.append(directory)
+    return dirs
+
+
+def bench_completion(tmp, counts, calls):
+    results = {}
+    for count in counts:
+        dirs = make_executables(os.path.join(tmp, f"path{count}"), count)
+        argv = [sys.executable, os.path.abspath(__file__), "--completion-worker", str(calls)] + dirs
+        _, rss, _, output = run_child(argv, capture=1)
+        result = json.loads(output)
+        result["executables"] = count
+        result["peak_rss_kb"] = rss
+        results[f"completion_{count}"] = result
+    return results
+
+
+def bench_redirection(tmp, size, count):
+    """MB/s for bulk > / >> / 2> and per-operation cost of small redirected builtins."""
+    target = os.path.join(tmp, "redirect.out")
+    results = {}
+    for name, line in (
+        ("truncate", f"head -c {size} /dev/zero > {target}"),
+        ("append", f"head -c {size} /dev/zero >> {target}"),
+        ("stderr", f"sh -c 'head -c {size} /dev/zero 1>&2' 2> {target}"),
+    ):
+        elapsed, rss, _, _ = run_shell(["-c", line], repeat=3 if size <= 64 * MB else 1)
+        results[f"redirect_{name}"] = {"bytes": size, "mb_per_s": size / MB / elapsed, "peak_rss_kb": rss}
+    baseline = startup_baseline(tmp)
+    for name, op in (("truncate", ">"), ("append", ">>"), ("stderr", "2>")):
+        results[f"redirect_{name}_small"] = bench_per_command(
+            tmp, f"redirect_{name}", f"echo small {op} {target}", count, baseline)
+    return results
+
+
+def bench_spill(sizes):
+    """Peak RSS while parallel jobs buffer large outputs; past PYSH_SPILL_BYTES
+    they go to disk, so it should not grow with the size."""
+    results = {}
+    for label, size in sizes:
+        n = size // 4
+        line = f"printf '%s\\n' {n} {n} {n} {n} | parallel -k -j 4 head -c {{}} /dev/zero | wc -c"
+        elapsed, rss, status, _ = run_shell(["-c", line], repeat=1)
+        results[f"spill_{label}"] = {
+            "bytes": size,
+            "mb_per_s": size / MB / elapsed,
+            "status": status,
+            "peak_rss_kb": rss,
+        }
+    return results
+
+
+# Scenario parameters rather than measurements; not worth comparing
+PARAMETERS = {"commands", "bytes", "executables", "status", "noise_us"}
+
+
+def compare(old, new):
+    """Print the relative change of every measured metric present in both runs."""
+    for scenario, metrics in new["results"].items():
+        before = old.get("results", {}).get(scenario)
+        if not before:
+            continue
+        for metric, value in metrics.items():
+            if metric in PARAMETERS:
+                continue
+            base = before.get(metric)
+            if isinstance(value, (int, float)) and isinstance(base, (int, float)) and base:
+                print(f"{scenario:40} {metric:16} {base:14.2f} -> {value:14.2f} ({(value - base) / base:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="compare against an earlier --json file")
+    parser.add_argument("--quick", action="store_true", help="small sizes for a smoke run")
+    parser.add_argument("--large-mb", type=int, default=2048, help="large pipeline payload in MiB")
+    parser.add_argument("--check-startup", nargs="?", type=float, const=STARTUP_BUDGET_MS, metavar="MS",
+                        help=f"only check app.main's import time against a budget ({STARTUP_BUDGET_MS} ms)")
+    parser.add_argument("--completion-worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("path_dirs", nargs="*", help=argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.completion_worker:
+        completion_worker(opts.path_dirs, opts.completion_worker)
+        return
+    if opts.check_startup is not None:
+        import_ms = import_time_ms()
+        print(f"app.main import: {import_ms:.1f} ms (budget {opts.check_startup:g} ms)")
+        sys.exit(0 if import_ms <= opts.check_startup else 1)
+
+    large = (16 if opts.quick else opts.large_mb) * MB
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        results.update(bench_startup(tmp))
+        results.update(bench_spawn(tmp, 200 if opts.quick else 2000))
+        results.update(bench_pipelines([("small", MB), ("large", large)]))
+        results.update(bench_completion(tmp, [1000, 5000] if opts.quick else [1000, 10000, 50000], 1000))
+        results.update(bench_redirection(tmp, large, 200 if opts.quick else 2000))
+        results.update(bench_spill([("small", 16 * MB), ("large", large)]))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "quick": opts.quick,
+        },
+        "results": results,
+    }
+    for scenario, metrics in results.items():
+        print(scenario, json.dumps(metrics))
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if opts.compare:
+        with open(opts.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()